@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""
+Cost of drawing the variates of delta terms one at a time (before) and in NumPy batches (after).
+
+Measures Repeat on some examples with the batches of delta_terms disabled (batches of size 1) and enabled.
+Run from the root of the repository:
+
+    PYTHONPATH=. python benchmarks/batched_sampling.py [-n 1000]
+"""
+import argparse
+import time
+from pathlib import Path
+
+from gdatalog import delta_terms
+from gdatalog.program import Program, Repeat
+
+EXAMPLES = Path(__file__).parent.parent / "examples"
+REPEAT_EXAMPLES = ("pigeon_poisson.asp", "bacterial_lineage_persistence.asp")
+
+
+def repeat(filename: str, times: int, batch_sizes: tuple[int, int]) -> float:
+    delta_terms.MIN_BATCH_SIZE, delta_terms.MAX_BATCH_SIZE = batch_sizes
+    delta_terms.seed(0)
+    program = Program((EXAMPLES / filename).read_text())
+    start = time.perf_counter()
+    Repeat.on(program, times)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number-of-times", type=int, default=1000)
+    args = parser.parse_args()
+
+    default_batch_sizes = delta_terms.MIN_BATCH_SIZE, delta_terms.MAX_BATCH_SIZE
+    print(f"{'example':<45} {'before (ms)':>12} {'after (ms)':>12} {'speedup':>8}")
+    for filename in REPEAT_EXAMPLES:
+        before = repeat(filename, args.number_of_times, (1, 1))
+        after = repeat(filename, args.number_of_times, default_batch_sizes)
+        print(f"{filename:<45} {before * 1e3:>12.1f} {after * 1e3:>12.1f} {before / after:>8.2f}")
+    delta_terms.MIN_BATCH_SIZE, delta_terms.MAX_BATCH_SIZE = default_batch_sizes
+
+
+if __name__ == "__main__":
+    main()
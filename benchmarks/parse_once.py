@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+Per-sample cost of loading the source of a program in a fresh clingo.Control.
+
+Compares re-parsing the source text (what Program.sms() used to do) with replaying the statements parsed once.
+Run from the root of the repository:
+
+    python benchmarks/parse_once.py [-n 1000]
+"""
+import argparse
+import time
+from pathlib import Path
+
+import clingo
+import clingo.ast
+
+EXAMPLES = Path(__file__).parent.parent / "examples"
+
+
+def load_by_parsing(code: str):
+    control = clingo.Control()
+    control.add("base", [], code)
+
+
+def load_by_replaying(statements: list):
+    control = clingo.Control()
+    with clingo.ast.ProgramBuilder(control) as builder:
+        for statement in statements:
+            builder.add(statement)
+
+
+def measure(function, *args, times: int) -> float:
+    start = time.perf_counter()
+    for _ in range(times):
+        function(*args)
+    return (time.perf_counter() - start) / times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number-of-times", type=int, default=1000)
+    args = parser.parse_args()
+
+    baseline = measure(clingo.Control, times=args.number_of_times)
+    print(f"{'example':<50} {'parse (us)':>12} {'replay (us)':>12} {'saved':>8}")
+    for filename in sorted(EXAMPLES.glob("*.asp")):
+        code = filename.read_text()
+        statements = []
+        try:
+            clingo.ast.parse_string(code, statements.append, logger=lambda *_: None)
+        except RuntimeError:
+            print(f"{filename.name:<50} {'syntax error':>12}")
+            continue
+        parsing = measure(load_by_parsing, code, times=args.number_of_times) - baseline
+        replaying = measure(load_by_replaying, statements, times=args.number_of_times) - baseline
+        print(f"{filename.name:<50} {parsing * 1e6:>12.1f} {replaying * 1e6:>12.1f} "
+              f"{(1 - replaying / parsing) * 100 if parsing > 0 else 0:>7.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Cost of the arithmetic on probabilities with the exact (Fraction), the float and the log backends of Probability.
+
+Measures the aggregation of frequencies (as in Repeat._probability_of), the products along chains of delta terms
+(as in SmartRepeat._probability_of) with binom probabilities, and a full smart enumeration of some examples.
+Run from the root of the repository:
+
+    PYTHONPATH=. python benchmarks/probability_backends.py [-n 10000] [-l 50]
+"""
+import argparse
+import time
+from functools import reduce
+from pathlib import Path
+
+from scipy import stats
+
+from gdatalog.delta_terms import Probability
+from gdatalog.program import Program, Repeat
+
+EXAMPLES = Path(__file__).parent.parent / "examples"
+SMART_EXAMPLES = ("colorable-with-smart.asp", "flip-coins-with-smart.asp")
+
+
+def aggregate_frequencies(times: int) -> Probability:
+    return sum((Probability.of(index % 7, 7 * times) for index in range(times)), Probability())
+
+
+def multiply_chains(times: int, length: int) -> Probability:
+    pmf = [Probability.from_float(stats.binom.pmf(x, 10, 0.3)) for x in range(11)]
+    res = Probability()
+    for index in range(times):
+        res += reduce(lambda p, x: p * pmf[(index + x) % 11], range(length), Probability.of(1, 1))
+    return res
+
+
+def smart_enumeration(filename: str) -> Probability:
+    repeat = Repeat.on(Program((EXAMPLES / filename).read_text()), smart=True)
+    while not repeat.repeat(1000):
+        pass
+    freq = repeat.sets_of_stable_models_frequency()
+    return sum((freq.frequency(key) for key in freq.keys()), Probability())
+
+
+def measure(function, *args) -> tuple[float, Probability]:
+    start = time.perf_counter()
+    res = function(*args)
+    return time.perf_counter() - start, res
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number-of-times", type=int, default=10000)
+    parser.add_argument("-l", "--length", type=int, default=50)
+    args = parser.parse_args()
+
+    tasks = [
+        ("aggregate frequencies", aggregate_frequencies, (args.number_of_times,)),
+        ("multiply binom chains", multiply_chains, (args.number_of_times, args.length)),
+    ] + [(filename, smart_enumeration, (filename,)) for filename in SMART_EXAMPLES]
+
+    others = Probability.BACKENDS[1:]
+    print(f"{'task':<45} " + ' '.join(f"{backend + ' (ms)':>14}" for backend in Probability.BACKENDS) + ' ' +
+          ' '.join(f"{backend + ' error':>12}" for backend in others))
+    for name, function, task_args in tasks:
+        elapsed, results = [], []
+        for backend in Probability.BACKENDS:
+            Probability.set_backend(backend)
+            seconds, res = measure(function, *task_args)
+            elapsed.append(seconds)
+            results.append(float(res))
+        Probability.set_backend("fraction")
+        print(f"{name:<45} " + ' '.join(f"{seconds * 1e3:>14.1f}" for seconds in elapsed) + ' ' +
+              ' '.join(f"{abs(results[0] - res):>12.1e}" for res in results[1:]))
+
+if __name__ == "__main__":
+    main()
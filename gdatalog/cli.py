@@ -1,7 +1,9 @@
 import dataclasses
+import os
+from fractions import Fraction
 from functools import reduce
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
 import typer
 import uvicorn
@@ -13,7 +15,7 @@ from rich.progress import Progress
 from rich.table import Table
 
 from gdatalog.delta_terms import Probability
-from gdatalog.program import Program, Repeat
+from gdatalog.program import Program, Repeat, SystematicRepeat
 
 
 @dataclasses.dataclass(frozen=True)
@@ -54,6 +56,26 @@ def main(
             "-n",
             help="Maximum number of stable models to compute (0 for unbounded)"
         ),
+        cache_size: int = typer.Option(
+            0, "--cache-size", help="Maximum number of results kept in memory (0 for unbounded)"
+        ),
+        cache_directory: Optional[Path] = typer.Option(
+            None, "--cache-directory", help="Spill the results evicted from memory to this directory"
+        ),
+        probability_backend: str = typer.Option(
+            "fraction", "--probability-backend",
+            help=f"Numeric backend for probabilities (one of {', '.join(Probability.BACKENDS)}; float is faster, log "
+                 "does not underflow on long chains of delta terms)"
+        ),
+        consequences: Optional[str] = typer.Option(
+            None, "--consequences",
+            help=f"Compute only the consequences of the stable models (one of {', '.join(Program.CONSEQUENCES)}), "
+                 "instead of enumerating them"
+        ),
+        solve_timeout: Optional[float] = typer.Option(
+            None, "--solve-timeout",
+            help="Stop the search of each sample after the given number of seconds (it is reported as timed out)"
+        ),
         debug: bool = typer.Option(False, "--debug", help="Print DEBUG information and stack traces on errors"),
 ):
     """
@@ -62,6 +84,13 @@ def main(
     global app_options
 
     validate('number_of_models', number_of_models, min_value=0)
+    validate('cache_size', cache_size, min_value=0)
+    if solve_timeout is not None:
+        validate('solve_timeout', solve_timeout, min_value=0)
+    if cache_directory is not None:
+        validate('cache_directory', cache_directory.is_dir(), equals=True,
+                 help_msg=f"Directory {cache_directory} does not exists")
+    Probability.set_backend(probability_backend)
     for filename in filenames:
         validate('filenames', filename.exists() and filename.is_file(), equals=True,
                        help_msg=f"File {filename} does not exists")
@@ -70,7 +99,9 @@ def main(
     for filename in filenames:
         with open(filename) as f:
             lines += f.readlines()
-    program = Program('\n'.join(lines), max_stable_models=number_of_models)
+    program = Program('\n'.join(lines), max_stable_models=number_of_models, cache_size=cache_size,
+                      cache_directory=None if cache_directory is None else str(cache_directory),
+                      consequences=consequences, solve_timeout=solve_timeout)
 
     app_options = AppOptions(
         program=program,
@@ -92,7 +123,12 @@ def command_run() -> None:
         title=f"Delta Terms - probability of this outcome {probability}",
         title_align="left",
     ))
-    if res.state.satisfiable:
+    if res.models.is_timed_out():
+        console.print('TIMED OUT')
+    elif res.state.satisfiable and app_options.program.consequences is not None:
+        console.print(Panel('\n'.join(str(atom) for atom in res.models[0]),
+                            title=f"{app_options.program.consequences.capitalize()} consequences", title_align="left"))
+    elif res.state.satisfiable:
         for index, model in enumerate(res.models, start=1):
             console.print(Panel('\n'.join(str(atom) for atom in model), title=f"Model {index} of {len(res.models)}",
                                 title_align="left"))
@@ -107,24 +143,63 @@ def command_repeat(
         smart_enumeration: bool = typer.Option(
             False, "--smart-enumeration", "-s",
             help="Activate smart enumeration (incompatible with named delta terms)"
-        )
+        ),
+        systematic_enumeration: bool = typer.Option(
+            False, "--systematic-enumeration", "-S",
+            help="Activate systematic (depth-first) enumeration (incompatible with named delta terms)"
+        ),
+        best_first: bool = typer.Option(
+            False, "--best-first", "-b",
+            help="Activate best-first enumeration, expanding the most probable outcomes first (implies -S)"
+        ),
+        epsilon: Optional[float] = typer.Option(
+            None, "--epsilon", help="Stop systematic enumeration when the unexplored probability is at most epsilon"
+        ),
+        time_budget: Optional[float] = typer.Option(
+            None, "--time-budget", help="Stop systematic enumeration after the given number of seconds"
+        ),
+        workers: int = typer.Option(1, "--workers", "-w", help="Number of worker processes"),
+        seed: Optional[int] = typer.Option(None, "--seed", help="Seed for the random generators"),
+        top_k: int = typer.Option(20, "--top-k", "-k", help="Show only the K most frequent outcomes"),
+        streaming: bool = typer.Option(
+            False, "--streaming",
+            help="Keep running aggregates instead of the traces of the runs (incompatible with -s and -S)"
+        ),
 ) -> None:
     """
     Run the program multiple times and print stats (frequency analysis).
     """
     validate('number_of_times', number_of_times, min_value=1)
     validate('update_frequency', update_frequency, min_value=1)
+    validate('workers', workers, min_value=1)
+    validate('top_k', top_k, min_value=1)
+    systematic_enumeration = systematic_enumeration or best_first
+    if epsilon is not None or time_budget is not None:
+        validate('systematic_enumeration', systematic_enumeration, equals=True,
+                 help_msg="--epsilon and --time-budget require systematic enumeration")
+    if epsilon is not None:
+        validate('epsilon', epsilon, min_value=0, max_value=1)
+    if time_budget is not None:
+        validate('time_budget', time_budget, min_value=0)
 
     def stats_table(repeat_result: Repeat):
-        freq = repeat_result.sets_of_stable_models_frequency()
+        # only the most frequent outcomes are rendered, and they are maintained by Repeat while sampling
+        top = repeat_result.top_sets_of_stable_models_frequency()
 
-        table = Table(title=f"Stats on {repeat_result.number_of_calls} runs")
+        title = f"Stats on {repeat_result.number_of_calls} runs"
+        if isinstance(repeat_result, SystematicRepeat):
+            title += f" (unexplored probability {repeat_result.unexplored})"
+        hidden = repeat_result.number_of_sets_of_stable_models - sum(1 for _, models in top
+                                                                      if not models.is_unexplored())
+        caption = f"{hidden} less frequent outcomes not shown" if hidden > 0 else None
+        table = Table(title=title, caption=caption)
         table.add_column("Probability", justify="right")
         table.add_column("Model #", justify="center")
         table.add_column("Model")
-        for (probability, models) in sorted(freq.values(), key=lambda x: x[0], reverse=True):
+        for (probability, models) in top:
             if len(models) == 0:
-                table.add_row(f"{probability}", "?" if models.is_unexplored() else "0")
+                table.add_row(f"{probability}",
+                              "?" if models.is_unexplored() else "timeout" if models.is_timed_out() else "0")
                 table.add_row()
                 continue
             for model_index, model in enumerate(models, start=1):
@@ -154,18 +229,81 @@ def command_repeat(
 
     to_be_done = number_of_times
     with Live(console=console) as live:
-        res = Repeat.on(app_options.program, smart=smart_enumeration)
+        res = Repeat.on(app_options.program, smart=smart_enumeration, workers=workers, seed=seed,
+                        systematic=systematic_enumeration, best_first=best_first, time_budget=time_budget,
+                        streaming=streaming, top_size=top_k,
+                        coverage=None if epsilon is None else Probability(Fraction(str(epsilon))).complement())
         live.update(stats_table(res))
 
-        while to_be_done > 0:
-            n = min(to_be_done, update_frequency)
-            early_stop = res.repeat(n)
-            if early_stop:
-                to_be_done = 0
-                number_of_times = res.number_of_calls
-            else:
-                to_be_done -= n
-            live.update(stats_table(res))
+        try:
+            while to_be_done > 0:
+                n = min(to_be_done, update_frequency)
+                early_stop = res.repeat(n)
+                if early_stop:
+                    to_be_done = 0
+                    number_of_times = res.number_of_calls
+                else:
+                    to_be_done -= n
+                live.update(stats_table(res))
+        finally:
+            res.close()
+
+
+@app.command(name="query")
+def command_query(
+        number_of_times: int = typer.Option(1000, "--number-of-times", "-n", help="Number of runs"),
+        smart_enumeration: bool = typer.Option(
+            False, "--smart-enumeration", "-s",
+            help="Activate smart enumeration (incompatible with named delta terms)"
+        ),
+        systematic_enumeration: bool = typer.Option(
+            False, "--systematic-enumeration", "-S",
+            help="Activate systematic (depth-first) enumeration (incompatible with named delta terms)"
+        ),
+        workers: int = typer.Option(1, "--workers", "-w", help="Number of worker processes"),
+        seed: Optional[int] = typer.Option(None, "--seed", help="Seed for the random generators"),
+        streaming: bool = typer.Option(
+            False, "--streaming",
+            help="Keep running aggregates instead of the traces of the runs (incompatible with -s and -S)"
+        ),
+        predicates: Optional[List[str]] = typer.Option(
+            None, "--predicate", "-p", help="Report only atoms of this predicate (name or name/arity)"
+        ),
+        confidence: float = typer.Option(0.95, "--confidence", help="Confidence level of the intervals"),
+) -> None:
+    """
+    Run the program multiple times and print the marginal probability of each atom (brave and cautious).
+    """
+    validate('number_of_times', number_of_times, min_value=1)
+    validate('workers', workers, min_value=1)
+    validate('confidence', confidence, min_value=0, max_value=1)
+
+    with console.status("Running..."):
+        res = Repeat.on(app_options.program, smart=smart_enumeration, workers=workers, seed=seed,
+                        systematic=systematic_enumeration, streaming=streaming)
+        try:
+            res.repeat(number_of_times)
+        finally:
+            res.close()
+
+    table = Table(title=f"Atom marginals on {res.number_of_calls} runs")
+    table.add_column("Atom")
+    table.add_column("Brave", justify="right")
+    table.add_column("CI", justify="center")
+    table.add_column("Cautious", justify="right")
+    table.add_column("CI", justify="center")
+    marginals = res.atom_marginals(predicates or None, confidence)
+    for atom in sorted(marginals, key=lambda a: str(a)):
+        marginal = marginals[atom]
+        table.add_row(
+            f"{atom}",
+            "-" if marginal.brave is None else f"{marginal.brave}",
+            "-" if marginal.brave is None else f"[{marginal.brave_interval[0]:.4f}, {marginal.brave_interval[1]:.4f}]",
+            "-" if marginal.cautious is None else f"{marginal.cautious}",
+            "-" if marginal.cautious is None else
+            f"[{marginal.cautious_interval[0]:.4f}, {marginal.cautious_interval[1]:.4f}]",
+        )
+    console.print(table)
 
 
 @app.command(name="server")
@@ -173,9 +311,32 @@ def command_server(
         port: int = typer.Option(8000, "--port", "-p",
                                  help="An available port to listen for incoming requests"),
         reload: bool = typer.Option(False, "--reload",
-                                    help="Reload server if source code changes (for development)")
+                                    help="Reload server if source code changes (for development)"),
+        workers: Optional[int] = typer.Option(None, "--workers", "-w",
+                                              help="Number of worker processes solving programs (default: CPUs)"),
+        max_pending: Optional[int] = typer.Option(
+            None, "--max-pending",
+            help="Maximum number of queued or running requests, after which requests are rejected (default: 4 per "
+                 "worker)"
+        ),
+        timeout: float = typer.Option(30, "--timeout", help="Maximum number of seconds to serve a request"),
+        program_cache_bytes: Optional[int] = typer.Option(
+            None, "--program-cache-bytes",
+            help="Estimated memory of the programs kept by each worker for reuse (0 to disable; default: 64MiB)"
+        ),
 ) -> None:
     """
     Run a server for GDatalog (program and other options are provided by JSON requests).
     """
+    if workers is not None:
+        validate('workers', workers, min_value=1)
+        os.environ["GDATALOG_SERVER_WORKERS"] = str(workers)
+    if max_pending is not None:
+        validate('max_pending', max_pending, min_value=1)
+        os.environ["GDATALOG_SERVER_MAX_PENDING"] = str(max_pending)
+    if program_cache_bytes is not None:
+        validate('program_cache_bytes', program_cache_bytes, min_value=0)
+        os.environ["GDATALOG_SERVER_PROGRAM_CACHE_BYTES"] = str(program_cache_bytes)
+    validate('timeout', timeout, min_value=0)
+    os.environ["GDATALOG_SERVER_TIMEOUT"] = str(timeout)
     uvicorn.run("gdatalog.server:app", port=port, reload=reload)
@@ -1,25 +1,91 @@
 import dataclasses
+import math
 import random
-from bisect import bisect_right
+from bisect import bisect_left
 from collections import OrderedDict
 from fractions import Fraction
 from functools import lru_cache
-from typing import Any, Tuple, Iterable, Optional
+from typing import Any, Tuple, Iterable, Optional, Callable
 
 import clingo
 import clingo.symbol
+import numpy
 import requests
 from dumbo_utils.validation import validate
-from scipy import stats
+from scipy import special, stats
 from typeguard import typechecked
 
 WIKIPEDIA_API_URL = "https://en.wikipedia.org/w/api.php"
 
 
+@typechecked
+def seed(value: Optional[int] = None) -> None:
+    """
+    Seed the random generators used by the delta terms (None to seed from fresh entropy).
+    """
+    random.seed(value)
+    numpy.random.seed(None if value is None else value % 2**32)
+    __batches.clear()
+
+
+MIN_BATCH_SIZE = 8
+MAX_BATCH_SIZE = 1024
+MAX_BATCHES = 256
+__batches: OrderedDict[tuple, tuple[list, int]] = OrderedDict()
+
+
+def draw(key: tuple, generate: Callable[[int], numpy.ndarray]) -> Any:
+    """
+    Return the next variate of the batch associated with key.
+
+    Batches are drawn in advance with generate(size), as NumPy has a large overhead on each call.
+    The first batch of a key has MIN_BATCH_SIZE variates, and each further batch doubles the size of the previous one
+    (up to MAX_BATCH_SIZE), so that keys used only a few times (e.g., many distinct parameters) draw few variates.
+    At most MAX_BATCHES batches are kept (the least recently created are dropped first).
+    """
+    entry = __batches.get(key)
+    if entry is None or not entry[0]:
+        size = MIN_BATCH_SIZE if entry is None else min(2 * entry[1], MAX_BATCH_SIZE)
+        batch = generate(size).tolist()
+        batch.reverse()  # variates are popped from the end
+        entry = __batches[key] = batch, size
+        if len(__batches) > MAX_BATCHES:
+            __batches.popitem(last=False)
+    return entry[0].pop()
+
+
+def uniform() -> float:
+    """
+    Return the next variate of the batch of uniform values in [0, 1).
+    """
+    return draw(("uniform",), numpy.random.random_sample)
+
+
 @typechecked
 @dataclasses.dataclass(order=True, frozen=True)
 class Probability:
-    value: Fraction = dataclasses.field(default=Fraction(0))
+    """
+    A probability, stored as an exact Fraction or as a float according to the selected backend.
+
+    The float backend trades exactness for speed: values are not validated after arithmetic operations, and rounding
+    errors below FLOAT_TOLERANCE are considered negligible.
+    The log backend stores the natural logarithm of the probability as a float, so that long products do not underflow;
+    Fraction values are always probabilities, and are converted to their logarithm on creation.
+    """
+    value: Fraction | float = dataclasses.field(default=Fraction(0))
+
+    BACKENDS = ("fraction", "float", "log")
+    FLOAT_TOLERANCE = 1e-12
+    __backend = ["fraction"]
+
+    @staticmethod
+    def backend() -> str:
+        return Probability.__backend[0]
+
+    @staticmethod
+    def set_backend(backend: str) -> None:
+        validate('backend', backend, is_in=Probability.BACKENDS)
+        Probability.__backend[0] = backend
 
     @staticmethod
     def validate(n: int, d: int):
@@ -28,32 +94,80 @@ class Probability:
 
     @staticmethod
     def of(n, d: int = 1):
+        if Probability.__backend[0] == "float":
+            Probability.validate(n, d)
+            return Probability(n / d)
+        if Probability.__backend[0] == "log":
+            Probability.validate(n, d)
+            return Probability(math.log(n) - math.log(d) if n > 0 else -math.inf)
         return Probability(Fraction(n, d))
 
+    @staticmethod
+    def from_float(value: float):
+        if Probability.__backend[0] == "float":
+            return Probability(float(value))
+        if Probability.__backend[0] == "log":
+            return Probability(math.log(value) if value > 0 else -math.inf)
+        return Probability(Fraction.from_float(value))
+
+    @staticmethod
+    def sum_of(probabilities: Iterable["Probability"]) -> "Probability":
+        """
+        The sum of the given probabilities (computed by log-sum-exp in the log backend).
+        """
+        if Probability.__backend[0] == "log":
+            values = [probability.value for probability in probabilities]
+            return Probability(float(special.logsumexp(values))) if values else Probability()
+        return sum(probabilities, Probability())
+
     def __post_init__(self):
-        self.validate(self.value.numerator, self.value.denominator)
+        if type(self.value) is Fraction:
+            self.validate(self.value.numerator, self.value.denominator)
+            if self.__backend[0] == "log":
+                object.__setattr__(self, 'value', math.log(self.value) if self.value > 0 else -math.inf)
 
     def __str__(self):
         # return f'{self.value} (~{float(self)})'
         return f'~{float(self):.16f}'
 
     def __float__(self):
+        if self.__backend[0] == "log":
+            return math.exp(self.value)
         return float(self.value)
 
     def __add__(self, other):
+        if self.__backend[0] == "log":
+            return Probability(float(numpy.logaddexp(self.value, other.value)))
         return Probability(self.value + other.value)
 
     def __sub__(self, other):
+        if self.__backend[0] == "log":
+            if other.value >= self.value:
+                return Probability(-math.inf)
+            return Probability(self.value + math.log1p(-math.exp(other.value - self.value)))
         return Probability(self.value - other.value)
 
     def __mul__(self, other):
+        if self.__backend[0] == "log":
+            return Probability(self.value + other.value)
         return Probability(self.value * other.value)
 
     def __truediv__(self, other):
+        if self.__backend[0] == "log":
+            return Probability(self.value - other.value)
         return Probability(self.value / other.value)
 
     def complement(self):
-        return Probability(Fraction(1) - self.value)
+        if self.__backend[0] == "log":
+            return Probability(math.log(-math.expm1(self.value)) if self.value < 0 else -math.inf)
+        return Probability(1 - self.value)
+
+    def is_negligible(self) -> bool:
+        if self.__backend[0] == "log":
+            return self.value < math.log(self.FLOAT_TOLERANCE)
+        if type(self.value) is Fraction:
+            return self.value == 0
+        return abs(self.value) < self.FLOAT_TOLERANCE
 
 
 @typechecked
@@ -72,19 +186,44 @@ class DeltaTermCall:
         return f'@{self.function}<{params}>({signature}) = {self.result} [{self.probability}]'
 
 
+class KnownTrace(Exception):
+    """
+    Raised while grounding when the delta terms called so far form a known (complete) trace.
+    """
+
+
 class DeltaTermsContext:
     __delta_terms = {}
     __mass_terms = {}
 
-    def __init__(self, calls_prefixes: Optional[dict[tuple[DeltaTermCall, ...], set[clingo.Symbol]]] = None):
+    MASS_CACHE_SIZE = 4096
+
+    def __init__(self, calls_prefixes: Optional[dict[tuple[DeltaTermCall, ...], set[clingo.Symbol]]] = None,
+                 most_probable: bool = False, known_traces: Optional[dict] = None,
+                 replay: tuple[DeltaTermCall, ...] = ()):
+        """
+        Known traces are given as a trie of nested dicts, mapping each DeltaTermCall to a node, and None to True if
+        the path to the node is a complete trace.
+        Grounding is deterministic once the results of the delta terms are fixed, so a known trace cannot be extended.
+        For the same reason, the calls of a trace can be replayed (in the same order) to ground the program again.
+        """
         self.__calls = []
+        self.__results = {}  # memoization of delta terms, which lives as long as the context (i.e., one sample)
         self.calls_prefixes = calls_prefixes or {}  # shared object
+        self.most_probable = most_probable
+        self.__known_traces = known_traces  # the node of the trie reached by the current calls
+        self.__replay = replay
+
+    def check_known_trace(self) -> None:
+        if self.__known_traces is not None and None in self.__known_traces:
+            raise KnownTrace()
 
     @classmethod
     def register(cls, name, code, mass = None):
         cls.__delta_terms[name] = code
         if mass is not None:
             cls.__mass_terms[name] = mass
+        cls.__mass.cache_clear()
 
     def as_restricted_clingo_context(self):
         return self.ClingoContext(self)
@@ -93,11 +232,26 @@ class DeltaTermsContext:
     def calls(self) -> tuple[DeltaTermCall, ...]:
         return tuple(self.__calls)
 
-    @lru_cache(maxsize=None)
     def delta(self, function, *signature):
+        key = (function, signature)
+        if key not in self.__results:
+            self.__results[key] = self.__delta(function, *signature)
+            if self.__known_traces is not None:
+                self.__known_traces = self.__known_traces.get(self.__calls[-1])
+                self.check_known_trace()
+        return self.__results[key]
+
+    def __delta(self, function, *signature):
         validate("delta function", function.type, equals=clingo.SymbolType.Function,
                  help_msg=f"The first argument of @delta must be a function")
         signature = clingo.Function(name='', arguments=signature)
+        if len(self.__calls) < len(self.__replay):
+            call = self.__replay[len(self.__calls)]
+            validate("replayed call", (call.function, call.params, call.signature),
+                     equals=(function.name, tuple(function.arguments), tuple(signature.arguments)),
+                     help_msg="The replayed trace does not match the program")
+            self.__calls.append(call)
+            return call.result
         if function.name:
             validate("delta function", function.name, is_in=self.__delta_terms,
                      help_msg=f"Unknown delta function {function.name}")
@@ -106,7 +260,8 @@ class DeltaTermsContext:
         else:
             result, probability, smart_enumeration_exhausted = mass_with_smart_enumeration(
                 *function.arguments,
-                disallow_list=self.calls_prefixes[self.calls] if self.calls in self.calls_prefixes else ()
+                disallow_list=self.calls_prefixes[self.calls] if self.calls in self.calls_prefixes else (),
+                most_probable=self.most_probable,
             )
         self.__calls.append(
             DeltaTermCall(
@@ -120,14 +275,19 @@ class DeltaTermsContext:
         )
         return result
 
-    @lru_cache(maxsize=None)
     def mass(self, function):
+        return self.__mass(function)
+
+    @classmethod
+    @lru_cache(maxsize=MASS_CACHE_SIZE)
+    def __mass(cls, function):
+        # mass functions are pure, and so their results are shared by all contexts
         validate("delta function", function.type, equals=clingo.SymbolType.Function,
                  help_msg=f"The first argument of @mass must be a function")
-        validate("delta function", function.name, is_in=self.__delta_terms,
+        validate("delta function", function.name, is_in=cls.__delta_terms,
                  help_msg=f"Unknown delta function {function.name}")
 
-        return clingo.Function("", self.__mass_terms[function.name](*function.arguments))
+        return clingo.Function("", cls.__mass_terms[function.name](*function.arguments))
 
     @typechecked
     @dataclasses.dataclass(order=True, frozen=True)
@@ -138,6 +298,8 @@ class DeltaTermsContext:
             try:
                 attr = getattr(self.__master, at_term)
                 return attr(*args)
+            except KnownTrace:
+                raise
             except Exception as e:
                 raise RuntimeError(f"ClingoContext failure: {e}") from e
 
@@ -153,7 +315,7 @@ def flip(bias_n: clingo.Symbol, bias_d: clingo.Symbol) -> Tuple[clingo.Symbol, P
     n, d = bias_n.number, bias_d.number
     Probability.validate(n, d)
     probability_of_1 = Probability.of(n, d)
-    res = 1 if (random.uniform(0, 1) * d <= n) else 0
+    res = 1 if (uniform() * d <= n) else 0
     prob = probability_of_1 if res == 1 else probability_of_1.complement()
     return clingo.Number(res), prob
 
@@ -170,7 +332,7 @@ def randint(a: clingo.Symbol, b: clingo.Symbol) -> Tuple[clingo.Symbol, Probabil
     _a, _b = a.number, b.number
     validate('a', _a)
     validate('b', _b, min_value=_a)
-    res = random.randint(_a, _b)
+    res = draw(("randint", _a, _b), lambda size: numpy.random.randint(_a, _b + 1, size))
     prob = Probability.of(1, _b - _a + 1)
     return clingo.Number(res), prob
 
@@ -192,11 +354,16 @@ def binom(n_classes: clingo.Symbol, p_numerator: clingo.Symbol, p_denominator: c
     n, p_n, p_d = n_classes.number, p_numerator.number, p_denominator.number
     validate('n_classes', n, min_value=1)
     Probability.validate(p_n, p_d)
-    res = stats.binom.rvs(n, p_n / p_d)
-    prob = Probability(Fraction.from_float(stats.binom.pmf(res, n, p_n / p_d)))
+    res = draw(("binom", n, p_n, p_d), lambda size: stats.binom.rvs(n, p_n / p_d, size=size))
+    prob = __binom_probability(res, n, p_n, p_d, Probability.backend())
     return clingo.Number(res), prob
 
 
+@lru_cache(maxsize=4096)
+def __binom_probability(x: int, n: int, p_n: int, p_d: int, backend: str) -> Probability:
+    return Probability.from_float(stats.binom.pmf(x, n, p_n / p_d))
+
+
 @typechecked
 def binom_mass(n_classes: clingo.Symbol, p_numerator: clingo.Symbol, p_denominator: clingo.Symbol, multiplier: clingo.Symbol = clingo.Number(10**9)) -> list[clingo.Symbol]:
     # We use a large multiplier to convert float probabilities from pmf to integer masses/biases
@@ -207,14 +374,16 @@ def binom_mass(n_classes: clingo.Symbol, p_numerator: clingo.Symbol, p_denominat
     validate('multiplier', m, min_value=100, help_msg="The multiplier must be large to have enough precision")
     Probability.validate(p_n, p_d)
 
-    res = []
-    for x in range(n + 1):
-        mass = int(stats.binom.pmf(x, n, p_n / p_d) * m)
-        if mass > 0:
-            res.append(
-                clingo.Function('', [clingo.Number(x), clingo.Number(mass)])
-            )
-    return res
+    return list(__binom_mass(n, p_n, p_d, m))
+
+
+@lru_cache(maxsize=1024)
+def __binom_mass(n: int, p_n: int, p_d: int, m: int) -> tuple[clingo.Symbol, ...]:
+    masses = (stats.binom.pmf(numpy.arange(n + 1), n, p_n / p_d) * m).astype(numpy.int64)
+    return tuple(
+        clingo.Function('', [clingo.Number(x), clingo.Number(mass)])
+        for x, mass in enumerate(masses.tolist()) if mass > 0
+    )
 
 
 @typechecked
@@ -222,11 +391,16 @@ def poisson(lambda_n: clingo.Symbol, lambda_d: clingo.Symbol) -> Tuple[clingo.Sy
     n, d = lambda_n.number, lambda_d.number
     validate('lambda_n', n, min_value=1)
     validate('lambda_d', d, min_value=1)
-    res = stats.poisson.rvs(n / d)
-    prob = Probability(Fraction.from_float(stats.poisson.pmf(res, n / d)))
+    res = draw(("poisson", n, d), lambda size: stats.poisson.rvs(n / d, size=size))
+    prob = __poisson_probability(res, n, d, Probability.backend())
     return clingo.Number(res), prob
 
 
+@lru_cache(maxsize=4096)
+def __poisson_probability(x: int, n: int, d: int, backend: str) -> Probability:
+    return Probability.from_float(stats.poisson.pmf(x, n / d))
+
+
 @typechecked
 def poisson_mass(lambda_n: clingo.Symbol, lambda_d: clingo.Symbol,
                  multiplier: clingo.Symbol = clingo.Number(10**9), stop_at: Optional[clingo.Symbol] = None) -> list[clingo.Symbol]:
@@ -239,21 +413,24 @@ def poisson_mass(lambda_n: clingo.Symbol, lambda_d: clingo.Symbol,
         stop = m * 9999 // 10000  # We want to cover at least 99.99% of the probability mass, but we also want to avoid too large lists. This is a heuristic that works well in practice.
     validate('stop_at', stop, min_value=1, max_value=m - 1, help_msg="There must be a stop!")
 
-    x, cumulate = 0, 0
-    res = []
+    return list(__poisson_mass(n, d, m, stop))
+
+
+@lru_cache(maxsize=1024)
+def __poisson_mass(n: int, d: int, m: int, stop: int) -> tuple[clingo.Symbol, ...]:
+    # the support is extended until the cumulative mass reaches stop; the quantile is a good first guess
+    size = max(64, int(stats.poisson.ppf(stop / m, n / d)) + 16)
     while True:
-        prob = stats.poisson.pmf(x, n / d) * m
-        cumulate += prob
-        prob = int(prob)
-        if prob > 0:
-            res.append(
-                clingo.Function('', [clingo.Number(x), clingo.Number(int(prob))])
-            )
-        if cumulate >= stop:
+        probs = stats.poisson.pmf(numpy.arange(size), n / d) * m
+        reached = numpy.flatnonzero(numpy.cumsum(probs) >= stop)
+        if len(reached) > 0:
             break
-        x += 1
-    return res
-
+        size *= 2
+    masses = probs[:reached[0] + 1].astype(numpy.int64)
+    return tuple(
+        clingo.Function('', [clingo.Number(x), clingo.Number(mass)])
+        for x, mass in enumerate(masses.tolist()) if mass > 0
+    )
 
 
 @lru_cache(maxsize=None)
@@ -285,25 +462,113 @@ def __validate_mass_with_smart_enumeration(*args: clingo.Symbol):
     return outcome_to_bias, sum(outcome_to_bias.values())
 
 
+@dataclasses.dataclass(frozen=True)
+class MassSampler:
+    """
+    Sampler of the outcomes of a mass, in constant time by Walker's alias method.
+
+    Thresholds of the alias table are integers (the biases scaled by the number of outcomes), so that the table is
+    exact. Disallowed outcomes are rejected as long as they cover at most half of the mass; otherwise, the outcome is
+    searched on the cumulative biases, corrected by the (sorted) disallowed ones, so that nothing is rebuilt.
+    """
+    outcomes: tuple[clingo.Symbol, ...]
+    biases: tuple[int, ...]
+    total: int
+    index: dict[clingo.Symbol, int]
+    thresholds: tuple[int, ...]
+    aliases: tuple[int, ...]
+    cumulative: tuple[int, ...]
+    most_probable_first: tuple[int, ...]
+
+    @staticmethod
+    def of(outcome_to_bias: OrderedDict) -> "MassSampler":
+        outcomes, biases = tuple(outcome_to_bias.keys()), tuple(outcome_to_bias.values())
+        n, total = len(biases), sum(biases)
+        scaled = [bias * n for bias in biases]
+        thresholds, aliases = [total] * n, list(range(n))
+        small = [index for index in range(n) if scaled[index] < total]
+        large = [index for index in range(n) if scaled[index] >= total]
+        while small and large:
+            the_small, the_large = small.pop(), large.pop()
+            thresholds[the_small], aliases[the_small] = scaled[the_small], the_large
+            scaled[the_large] -= total - scaled[the_small]
+            (small if scaled[the_large] < total else large).append(the_large)
+        cumulative = [0]
+        for bias in biases:
+            cumulative.append(cumulative[-1] + bias)
+        return MassSampler(
+            outcomes=outcomes,
+            biases=biases,
+            total=total,
+            index={outcome: index for index, outcome in enumerate(outcomes)},
+            thresholds=tuple(thresholds),
+            aliases=tuple(aliases),
+            cumulative=tuple(cumulative),
+            most_probable_first=tuple(sorted(range(n), key=lambda index: -biases[index])),
+        )
+
+    def sample(self, disallow_list: Iterable[clingo.Symbol] = (), most_probable: bool = False) -> Tuple[int, int]:
+        """
+        Return the index of the sampled outcome and the number of allowed outcomes.
+        """
+        disallowed = set(self.index[outcome] for outcome in disallow_list if outcome in self.index)
+        allowed = len(self.outcomes) - len(disallowed)
+        validate("disallow_list", allowed, min_value=1, help_msg="All outcomes are disallowed")
+        if most_probable:
+            return next(index for index in self.most_probable_first if index not in disallowed), allowed
+        disallowed_mass = sum(self.biases[index] for index in disallowed)
+        if 2 * disallowed_mass <= self.total:
+            while True:
+                res = self.__alias()
+                if res not in disallowed:
+                    return res, allowed
+        return self.__search(sorted(disallowed), self.total - disallowed_mass), allowed
+
+    def __alias(self) -> int:
+        x = uniform() * len(self.outcomes)
+        index = min(int(x), len(self.outcomes) - 1)
+        return index if (x - index) * self.total < self.thresholds[index] else self.aliases[index]
+
+    def __search(self, disallowed: list[int], allowed_mass: int) -> int:
+        disallowed_cumulative = [0]
+        for index in disallowed:
+            disallowed_cumulative.append(disallowed_cumulative[-1] + self.biases[index])
+
+        def allowed_prefix(position):
+            return self.cumulative[position] - disallowed_cumulative[bisect_left(disallowed, position)]
+
+        rand = int(uniform() * allowed_mass) if allowed_mass < 2**53 else random.randint(0, allowed_mass - 1)
+        low, high = 0, len(self.outcomes) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if allowed_prefix(middle + 1) > rand:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+
+@lru_cache(maxsize=4096)
+def __mass_sampler(*args: clingo.Symbol) -> MassSampler:
+    outcome_to_bias, _ = __validate_mass_with_smart_enumeration(*args)
+    return MassSampler.of(outcome_to_bias)
+
+
 @typechecked
 def mass_with_smart_enumeration(
         *args: clingo.Symbol,
-        disallow_list: Iterable[clingo.Symbol] = ()
+        disallow_list: Iterable[clingo.Symbol] = (),
+        most_probable: bool = False,
 ) -> Tuple[clingo.Symbol, Probability, bool]:
+    sampler = __mass_sampler(*args)
+    res, allowed = sampler.sample(disallow_list, most_probable)
+    return sampler.outcomes[res], Probability.of(sampler.biases[res], sampler.total), allowed == 1
+
+
+@typechecked
+def smart_enumeration_outcomes(*args: clingo.Symbol) -> list[Tuple[clingo.Symbol, Probability]]:
     outcome_to_bias, sum_of_all_bias = __validate_mass_with_smart_enumeration(*args)
-    outcome_to_bias_items = tuple(outcome_to_bias.items())
-    allowed_list = []
-    cumulative_bias = [0]
-    for index, (outcome, bias) in enumerate(outcome_to_bias_items):
-        if outcome not in disallow_list:
-            allowed_list.append(index)
-            cumulative_bias.append(cumulative_bias[-1] + bias)
-    sum_bias = cumulative_bias[-1]
-    rand = random.randint(0, sum_bias - 1)
-    res = bisect_right(cumulative_bias, rand, 0, len(cumulative_bias)) - 1
-    res = allowed_list[res]
-    outcome, bias = outcome_to_bias_items[res]
-    return outcome, Probability.of(bias, sum_of_all_bias), len(allowed_list) == 1
+    return [(outcome, Probability.of(bias, sum_of_all_bias)) for outcome, bias in outcome_to_bias.items()]
 
 
 @lru_cache()
@@ -1,16 +1,32 @@
 import dataclasses
-from collections import defaultdict
+import heapq
+import math
+import multiprocessing
+import os
+import shelve
+import shutil
+import tempfile
+import time
+import weakref
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import InitVar
+from fractions import Fraction
 from functools import reduce
-from typing import Dict, Optional
+from typing import Any, Callable, Dict, Optional, Iterable
 
 import clingo
+import clingo.ast
+import numpy
 import typeguard
+from dumbo_asp.primitives.atoms import GroundAtom
 from dumbo_utils.validation import validate
+from scipy import stats
 
-from gdatalog import utils
-from gdatalog.delta_terms import DeltaTermsContext, DeltaTermCall, Probability
-from gdatalog.utils import ModelList
+from gdatalog import utils, delta_terms as delta_terms_module
+from gdatalog.delta_terms import DeltaTermsContext, DeltaTermCall, Probability, smart_enumeration_outcomes, \
+    KnownTrace
+from gdatalog.utils import ModelList, Fingerprint, SymbolTable
 
 
 @typeguard.typechecked
@@ -32,14 +48,14 @@ class SmsResult:
 @typeguard.typechecked
 @dataclasses.dataclass(frozen=True)
 class SetsOfStableModelsFrequency:
-    __frequency: Dict[str, Probability]
-    __models: Dict[str, ModelList]
+    __frequency: Dict[Fingerprint | str, Probability]
+    __models: Dict[Fingerprint | str, ModelList]
 
     def __post_init__(self):
         validate('same_keys', self.__frequency.keys(), equals=self.__models.keys())
         # introduce the "UNEXPLORED" key for the case of smart enumeration
-        total = sum(self.__frequency.values(), Probability.of(0, 1))
-        if total < Probability.of(1, 1):
+        total = Probability.sum_of(self.__frequency.values())
+        if total < Probability.of(1, 1) and not total.complement().is_negligible():
             self.__frequency['UNEXPLORED'] = Probability.of(1, 1) - total
             self.__models['UNEXPLORED'] = ModelList.unexplored()
         # normalize frequencies
@@ -72,41 +88,514 @@ class SetsOfStableModelsFrequency:
             print(f'Probability: {x[0]}')
             if x[1].is_unexplored():
                 print('  Models: UNEXPLORED')
+            elif x[1].is_timed_out():
+                print('  Models: TIMED OUT')
             else:
                 print(f'  Models: {len(x[1])}')
                 for i in range(len(x[1])):
                     print(f'  Model: {x[1][i]}')
 
 
+@typeguard.typechecked
+@dataclasses.dataclass(frozen=True)
+class AtomMarginal:
+    """
+    Frequency of the samples having an atom as a brave consequence (in some stable model) and as a cautious consequence
+    (in all stable models), with their confidence intervals.
+    """
+    brave: Optional[Probability]
+    cautious: Optional[Probability]
+    brave_interval: Optional[tuple[float, float]]
+    cautious_interval: Optional[tuple[float, float]]
+
+
+def _wilson_interval(frequency: float, samples: int, confidence: float) -> tuple[float, float]:
+    # Wilson score interval of a binomial proportion
+    if samples == 0:
+        return 0., 1.
+    z = stats.norm.ppf(1 - (1 - confidence) / 2)
+    denominator = 1 + z * z / samples
+    center = (frequency + z * z / (2 * samples)) / denominator
+    half_width = z * math.sqrt(frequency * (1 - frequency) / samples + z * z / (4 * samples * samples)) / denominator
+    return max(0., center - half_width), min(1., center + half_width)
+
+
+def _walk(node: clingo.ast.AST) -> Iterable[clingo.ast.AST]:
+    yield node
+    for key in node.child_keys:
+        child = getattr(node, key)
+        if isinstance(child, clingo.ast.AST):
+            yield from _walk(child)
+        elif child is not None:
+            for element in child:
+                yield from _walk(element)
+
+
+def _predicate_of(atom: clingo.ast.AST) -> Optional[tuple[str, int, bool]]:
+    term, positive = atom.symbol, True
+    if term.ast_type == clingo.ast.ASTType.UnaryOperation and \
+            term.operator_type == clingo.ast.UnaryOperator.Minus:
+        term, positive = term.argument, False
+    if term.ast_type == clingo.ast.ASTType.Function:
+        return term.name, len(term.arguments), positive
+    if term.ast_type == clingo.ast.ASTType.SymbolicTerm and term.symbol.type == clingo.SymbolType.Function:
+        return term.symbol.name, len(term.symbol.arguments), positive and term.symbol.positive
+    return None
+
+
+def _predicates_in(node: clingo.ast.AST) -> set[Optional[tuple[str, int, bool]]]:
+    return set(_predicate_of(x) for x in _walk(node) if x.ast_type == clingo.ast.ASTType.SymbolicAtom)
+
+
+def _is_constraint(rule: clingo.ast.AST) -> bool:
+    return rule.head.ast_type == clingo.ast.ASTType.Literal and \
+        rule.head.atom.ast_type == clingo.ast.ASTType.BooleanConstant
+
+
+def _calls_delta(node: clingo.ast.AST) -> bool:
+    return any(x.ast_type == clingo.ast.ASTType.Function and x.external and x.name == "delta" for x in _walk(node))
+
+
+class SmsResultCache:
+    """
+    Cache of SmsResult by delta terms, possibly bounded in size (the least recently used results are evicted first).
+
+    Evicted results are lost, unless a directory is given: in this case, they are spilled to disk and reloaded on demand.
+    The traces of the available results are also stored in a trie (see DeltaTermsContext).
+    The memory of the results kept in memory is estimated (see bytes) by the following sizes, measured on CPython.
+    """
+    RESULT_BYTES = 1024
+    CALL_BYTES = 512
+    MODEL_BYTES = 128
+    ID_BYTES = 8
+
+    def __init__(self, max_size: int = 0, directory: Optional[str] = None):
+        validate('max_size', max_size, min_value=0, help_msg="Use 0 for an unbounded cache")
+        self.__results: OrderedDict[tuple[DeltaTermCall, ...], SmsResult] = OrderedDict()
+        self.__traces = {}
+        self.__max_size = max_size
+        self.__bytes = 0
+        self.__directory = directory
+        self.__spilled = None
+        self.__spilled_pid = None
+
+    @property
+    def __shelf(self) -> Optional[shelve.Shelf]:
+        # opened on demand by each process, as a process forked from this one must not write to the same file (its
+        # results spilled by the parent are lost, but their traces are grounded again, see Program.sms())
+        if self.__directory is not None and self.__spilled_pid != os.getpid():
+            path = tempfile.mkdtemp(prefix="sms-results-", dir=self.__directory)
+            self.__spilled = shelve.open(os.path.join(path, "cache"))
+            self.__spilled_pid = os.getpid()
+            weakref.finalize(self, self.__remove, self.__spilled, path, self.__spilled_pid)
+        return self.__spilled
+
+    @staticmethod
+    def __remove(spilled: shelve.Shelf, path: str, pid: int) -> None:
+        # forked processes inherit the finalizer, but the shelf belongs to the process that opened it
+        if os.getpid() != pid:
+            return
+        spilled.close()
+        shutil.rmtree(path, ignore_errors=True)
+
+    @property
+    def traces(self) -> dict:
+        return self.__traces
+
+    @property
+    def bytes(self) -> int:
+        """
+        Estimated memory of the results kept in memory (spilled results are excluded).
+        """
+        return self.__bytes
+
+    def __size(self, result: SmsResult) -> int:
+        # each id is stored by its model and by the fingerprint of the models
+        models = result.models
+        return self.RESULT_BYTES + self.CALL_BYTES * len(result.delta_terms) + \
+            sum(self.MODEL_BYTES + self.ID_BYTES * len(models.ids(index)) for index in range(len(models)))
+
+    def __add_trace(self, delta_terms: tuple[DeltaTermCall, ...]) -> None:
+        node = self.__traces
+        for call in delta_terms:
+            node = node.setdefault(call, {})
+        node[None] = True
+
+    def __remove_trace(self, delta_terms: tuple[DeltaTermCall, ...]) -> None:
+        path = [self.__traces]
+        for call in delta_terms:
+            path.append(path[-1][call])
+        del path[-1][None]
+        for index in range(len(delta_terms) - 1, -1, -1):
+            if path[index + 1]:
+                break
+            del path[index][delta_terms[index]]
+
+    def __len__(self):
+        return len(self.__results) + (len(self.__shelf) if self.__shelf is not None else 0)
+
+    @staticmethod
+    def __spill_key(delta_terms: tuple[DeltaTermCall, ...]) -> str:
+        # the same fields compared by DeltaTermCall (smart enumeration flags are excluded), as for the trie of traces
+        return repr(tuple((call.function, call.params, call.signature, call.result, call.probability)
+                          for call in delta_terms))
+
+    def __contains__(self, delta_terms: tuple[DeltaTermCall, ...]) -> bool:
+        return delta_terms in self.__results or \
+            (self.__shelf is not None and self.__spill_key(delta_terms) in self.__shelf)
+
+    def get(self, delta_terms: tuple[DeltaTermCall, ...]) -> Optional[SmsResult]:
+        if delta_terms in self.__results:
+            self.__results.move_to_end(delta_terms)
+            return self.__results[delta_terms]
+        if self.__shelf is not None and self.__spill_key(delta_terms) in self.__shelf:
+            return self.setdefault(delta_terms, self.__shelf.pop(self.__spill_key(delta_terms)))
+        return None
+
+    def __getitem__(self, delta_terms: tuple[DeltaTermCall, ...]) -> SmsResult:
+        res = self.get(delta_terms)
+        if res is None:
+            raise KeyError(delta_terms)
+        return res
+
+    def setdefault(self, delta_terms: tuple[DeltaTermCall, ...], result: SmsResult) -> SmsResult:
+        res = self.get(delta_terms)
+        if res is not None:
+            return res
+        self.__results[delta_terms] = result
+        self.__bytes += self.__size(result)
+        self.__add_trace(delta_terms)
+        if self.__max_size and len(self.__results) > self.__max_size:
+            evicted_delta_terms, evicted = self.__results.popitem(last=False)
+            self.__bytes -= self.__size(evicted)
+            if self.__shelf is not None:
+                self.__shelf[self.__spill_key(evicted_delta_terms)] = evicted
+            else:
+                self.__remove_trace(evicted_delta_terms)
+        return result
+
+
+class FrequencyTable:
+    """
+    Weights of keys (e.g., counters or probabilities of sets of stable models), updated as samples arrive.
+
+    The heaviest keys are also tracked incrementally, so that they are obtained in time linear in their number, no
+    matter how many keys there are.
+    Weights cannot decrease, so that a key can enter the heaviest keys only by exceeding the lightest of them.
+    """
+    def __init__(self, top_size: int = 20):
+        validate('top_size', top_size, min_value=1)
+        self.__weights = {}
+        self.__total = None
+        self.__top = set()
+        self.__top_size = top_size
+        self.__lightest = None
+
+    def __len__(self):
+        return len(self.__weights)
+
+    def __contains__(self, key) -> bool:
+        return key in self.__weights
+
+    def __getitem__(self, key):
+        return self.__weights[key]
+
+    def items(self):
+        return self.__weights.items()
+
+    @property
+    def total(self):
+        return self.__total
+
+    def add(self, key, weight) -> None:
+        self.__weights[key] = self.__weights[key] + weight if key in self.__weights else weight
+        self.__total = self.__total + weight if self.__total is not None else weight
+        if key in self.__top:
+            if key == self.__lightest:
+                self.__lightest = None
+            return
+        if len(self.__top) < self.__top_size:
+            self.__top.add(key)
+            self.__lightest = None
+            return
+        if self.__lightest is None:
+            self.__lightest = min(self.__top, key=self.__weights.__getitem__)
+        if self.__weights[key] > self.__weights[self.__lightest]:
+            self.__top.remove(self.__lightest)
+            self.__top.add(key)
+            self.__lightest = None
+
+    def top(self) -> list[tuple]:
+        """
+        Return the heaviest keys and their weights, by decreasing weight.
+        """
+        return sorted(((key, self.__weights[key]) for key in self.__top), key=lambda item: item[1], reverse=True)
+
+
 @typeguard.typechecked
 @dataclasses.dataclass(frozen=True)
 class Program:
     code: str
     max_stable_models: int = dataclasses.field(default=0)
-    __delta_terms_to_sms_result: Dict[tuple[DeltaTermCall, ...], SmsResult] = dataclasses.field(default_factory=dict)
+    cache_size: int = dataclasses.field(default=0)
+    cache_directory: Optional[str] = dataclasses.field(default=None)
+    consequences: Optional[str] = dataclasses.field(default=None)
+    solve_timeout: Optional[float] = dataclasses.field(default=None)
+    __delta_terms_to_sms_result: SmsResultCache = dataclasses.field(default=None, init=False)
+    __symbols: SymbolTable = dataclasses.field(default_factory=SymbolTable, init=False)
+    __statements: list[clingo.ast.AST] = dataclasses.field(default_factory=list, init=False)
+
+    __SPLITTABLE_STATEMENTS = (
+        clingo.ast.ASTType.Rule,
+        clingo.ast.ASTType.Program,
+        clingo.ast.ASTType.Definition,
+        clingo.ast.ASTType.ShowSignature,
+        clingo.ast.ASTType.ShowTerm,
+        clingo.ast.ASTType.Minimize,
+        clingo.ast.ASTType.Comment,
+    )
+
+    CONSEQUENCES = ("brave", "cautious")
+
+    def __post_init__(self):
+        if self.consequences is not None:
+            validate('consequences', self.consequences, is_in=self.CONSEQUENCES)
+            validate('max_stable_models', self.max_stable_models, equals=0,
+                     help_msg="Consequences are computed over all stable models")
+        if self.solve_timeout is not None:
+            validate('solve_timeout', self.solve_timeout, min_value=0)
+        object.__setattr__(self, '_Program__delta_terms_to_sms_result',
+                           SmsResultCache(self.cache_size, self.cache_directory))
+        # parse once, and replay the statements in the Control of each sample
+        clingo.ast.parse_string(self.code, self.__statements.append)
+        self.__ground_deterministic_part()
+
+    def __ground_deterministic_part(self) -> None:
+        """
+        Replace the rules that do not depend on delta terms with the facts they derive.
+
+        A rule depends on delta terms if it contains @delta, or if it mentions a predicate defined by a rule depending
+        on delta terms.
+        The other rules (constraints excluded) are grounded once, and if the grounder evaluates them to a set of facts
+        (e.g., they are stratified) such facts are added to the Control of each sample in place of the rules.
+        Only facts that are used by the rest of the program, or that are shown, are added.
+        Otherwise, the program is left untouched.
+        """
+        statements = self.__statements
+        if any(statement.ast_type not in self.__SPLITTABLE_STATEMENTS or
+               (statement.ast_type == clingo.ast.ASTType.Program and (statement.name != "base" or statement.parameters))
+               for statement in statements):
+            return
+
+        rules = [(index, _predicates_in(statement)) for index, statement in enumerate(statements)
+                 if statement.ast_type == clingo.ast.ASTType.Rule]
+        if any(None in predicates for _, predicates in rules):
+            return
+
+        dependent_rules = set(index for index, _ in rules if _calls_delta(statements[index]))
+        dependent_predicates = set().union(*(_predicates_in(statements[index].head) for index in dependent_rules))
+        changed = True
+        while changed:
+            changed = False
+            for index, predicates in rules:
+                if index not in dependent_rules and not predicates.isdisjoint(dependent_predicates):
+                    dependent_rules.add(index)
+                    dependent_predicates.update(_predicates_in(statements[index].head))
+                    changed = True
+
+        deterministic_rules = set(index for index, _ in rules
+                                  if index not in dependent_rules and not _is_constraint(statements[index]))
+        if not deterministic_rules:
+            return
+
+        control = clingo.Control()
+        with clingo.ast.ProgramBuilder(control) as builder:
+            for index, statement in enumerate(statements):
+                if index in deterministic_rules or statement.ast_type == clingo.ast.ASTType.Definition:
+                    builder.add(statement)
+        control.ground([("base", [])], context=DeltaTermsContext().as_restricted_clingo_context())
+        if not all(atom.is_fact for atom in control.symbolic_atoms):
+            return
+
+        location = statements[0].location
+        deterministic_predicates = set().union(*(predicates for index, predicates in rules
+                                                 if index in deterministic_rules))
+        statements[:] = [statement for index, statement in enumerate(statements) if index not in deterministic_rules]
+        show_signatures = [(statement.name, statement.arity, statement.positive) for statement in statements
+                           if statement.ast_type == clingo.ast.ASTType.ShowSignature]
+        if show_signatures:
+            needed_predicates = set(show_signatures).union(*(_predicates_in(statement) for statement in statements))
+        else:
+            needed_predicates = deterministic_predicates
+        facts = ''.join(f"{atom.symbol}." for atom in control.symbolic_atoms
+                        if (atom.symbol.name, len(atom.symbol.arguments), atom.symbol.positive) in needed_predicates)
+        clingo.ast.parse_string(facts, statements.append)
+        # the predicates of the removed rules are still defined (and possibly empty)
+        for name, arity, positive in sorted(deterministic_predicates):
+            statements.append(clingo.ast.Defined(location, name, arity, positive))
+
+    @property
+    def symbols(self) -> SymbolTable:
+        """
+        The table interning the shown atoms of the models of this program.
+        """
+        return self.__symbols
+
+    @property
+    def cached_results_bytes(self) -> int:
+        """
+        Estimated memory of the results cached in memory by this program.
+        """
+        return self.__delta_terms_to_sms_result.bytes
+
+    def __reduce__(self):
+        # parsed statements, symbols and cached results are not shipped (e.g., to worker processes)
+        return Program, (self.code, self.max_stable_models, self.cache_size, self.cache_directory, self.consequences,
+                         self.solve_timeout)
+
+    def _record(self, result: SmsResult) -> SmsResult:
+        return self.__delta_terms_to_sms_result.setdefault(result.delta_terms, result)
 
     def sms(self, *, delta_terms: Optional[tuple[DeltaTermCall, ...]] = None,
-            calls_prefixes: Optional[dict[tuple[DeltaTermCall, ...], set[clingo.Symbol]]] = None) -> SmsResult:
+            calls_prefixes: Optional[dict[tuple[DeltaTermCall, ...], set[clingo.Symbol]]] = None,
+            most_probable: bool = False, record: bool = True) -> SmsResult:
+        """
+        Sample a trace of the program and compute its stable models.
+        Results are added to the cache of the program (and its trace to the known traces) unless record is False or the
+        solver timed out.
+        """
         if delta_terms is not None:
             return self.__delta_terms_to_sms_result[delta_terms]
 
-        context = DeltaTermsContext(calls_prefixes)
-        model_collect = utils.ModelCollect()
+        context = DeltaTermsContext(calls_prefixes, most_probable, self.__delta_terms_to_sms_result.traces)
+        model_collect = utils.ModelCollect(self.__symbols)
 
-        control = clingo.Control()
-        control.configuration.solve.models = self.max_stable_models
-        control.add("base", [], self.code)
-        control.ground([("base", [])], context=context.as_restricted_clingo_context())
+        # grounding is aborted as soon as the delta terms form a trace whose result is cached
+        control = None
+        try:
+            context.check_known_trace()
+            control = self.__ground(context)
+        except KnownTrace:
+            control = None
 
         delta_terms = context.calls
-        if delta_terms not in self.__delta_terms_to_sms_result:
-            res = control.solve(on_model=model_collect)
-            self.__delta_terms_to_sms_result[delta_terms] = SmsResult(
-                state=res,
-                models=ModelList.of(x for x in model_collect),
-                delta_terms=delta_terms,
-            )
-        return self.__delta_terms_to_sms_result[delta_terms]
+        res = self.__delta_terms_to_sms_result.get(delta_terms)
+        if res is None:
+            if control is None:
+                # the trace is known, but its result is not available anymore: ground again with the same calls
+                control = self.__ground(DeltaTermsContext(replay=delta_terms))
+            state, timed_out = self.__solve(control, model_collect)
+            if timed_out:
+                # partial results are discarded, so that timed out samples form an outcome on their own
+                models = ModelList.timed_out()
+            else:
+                # with consequences, the last model is the set of consequences (and the others are its estimates)
+                models = ModelList.of_ids(model_collect[-1:] if self.consequences is not None else model_collect,
+                                          self.__symbols)
+            res = SmsResult(state=state, models=models, delta_terms=delta_terms)
+            # a timeout may not occur again (e.g., on a less loaded machine), so that it is not cached
+            if record and not timed_out:
+                res = self._record(res)
+        if calls_prefixes is not None:
+            # smart enumeration flags depend on the current calls prefixes, not on the ones of the cached result
+            return dataclasses.replace(res, delta_terms=delta_terms)
+        return res
+
+    def __ground(self, context: DeltaTermsContext) -> clingo.Control:
+        res = clingo.Control()
+        res.configuration.solve.models = self.max_stable_models
+        if self.consequences is not None:
+            # a single search, refining the consequences with each model, instead of enumerating the models
+            res.configuration.solve.enum_mode = self.consequences
+        with clingo.ast.ProgramBuilder(res) as builder:
+            for statement in self.__statements:
+                builder.add(statement)
+        res.ground([("base", [])], context=context.as_restricted_clingo_context())
+        return res
+
+    def __solve(self, control: clingo.Control, model_collect: utils.ModelCollect) -> tuple[clingo.SolveResult, bool]:
+        # the search is cancelled when it exceeds the timeout, so that a pathological sample cannot stall a repeat
+        if self.solve_timeout is None:
+            return control.solve(on_model=model_collect), False
+        with control.solve(on_model=model_collect, async_=True) as handle:
+            timed_out = not handle.wait(self.solve_timeout)
+            if timed_out:
+                handle.cancel()
+            return handle.get(), timed_out
+
+
+def _validate_unnamed(delta_terms: tuple[DeltaTermCall, ...]) -> None:
+    validate("unnamed delta terms only", all(delta_term.function == "" for delta_term in delta_terms),
+             equals=True, help_msg="Smart enumeration is incompatible with named delta terms")
+
+
+def _forcing(prefix: tuple[DeltaTermCall, ...]) -> dict[tuple[DeltaTermCall, ...], set[clingo.Symbol]]:
+    # disallow all other outcomes of the delta terms in prefix
+    return {
+        prefix[:index]: set(outcome for outcome, _ in smart_enumeration_outcomes(*call.params)
+                            if outcome != call.result)
+        for index, call in enumerate(prefix)
+    }
+
+
+def _branches(call: DeltaTermCall) -> list[DeltaTermCall]:
+    # the calls obtained by replacing the outcome of call
+    return [dataclasses.replace(call, result=outcome, probability=probability, smart_enumeration_exhausted=False)
+            for outcome, probability in smart_enumeration_outcomes(*call.params)]
+
+
+_worker_program: list[Program] = []
+
+
+def _to_symbols(models: ModelList) -> Optional[tuple]:
+    # models sent to other processes (timed out samples have no models, but must not be confused with incoherent ones)
+    return None if models.is_timed_out() else models.to_symbols()
+
+
+def _of_symbols(models: Optional[tuple], symbols: SymbolTable) -> ModelList:
+    return ModelList.timed_out() if models is None else ModelList.of_symbols(models, symbols)
+
+
+def _init_worker(program: Program, probability_backend: str) -> None:
+    _worker_program[:] = [program]
+    Probability.set_backend(probability_backend)
+
+
+def _stable_models_frequency_under_uniform_distribution(
+        outcomes: Iterable[tuple[ModelList, Probability]]) -> SetsOfStableModelsFrequency:
+    # the probability of each outcome is split evenly among its stable models
+    frequency = defaultdict(lambda: Probability())
+    models = {}
+    for outcome_models, probability in outcomes:
+        if outcome_models:
+            share = probability * Probability.of(1, len(outcome_models))
+            for index, fingerprint in enumerate(outcome_models.model_fingerprints):
+                frequency[fingerprint] += share
+                if fingerprint not in models:
+                    models[fingerprint] = outcome_models.sublist(index)
+        elif outcome_models.is_timed_out():
+            frequency['TIMED OUT'] += probability
+            models['TIMED OUT'] = outcome_models
+        else:
+            frequency['INCOHERENT'] += probability
+            models['INCOHERENT'] = ModelList.of([])
+    return SetsOfStableModelsFrequency(frequency, models)
+
+
+def _repeat_in_worker(times: int, seed: int, streaming: bool) -> tuple:
+    res = Repeat.on(_worker_program[0], times, seed=seed, streaming=streaming)
+    return res._aggregates()
+
+
+def _smart_repeat_in_worker(calls_prefixes: dict[tuple[DeltaTermCall, ...], set[clingo.Symbol]], times: int,
+                            seed: int) -> tuple[dict[tuple[DeltaTermCall, ...], int],
+                                                dict[tuple[DeltaTermCall, ...], Fingerprint],
+                                                dict[Fingerprint, Optional[tuple]],
+                                                dict[clingo.Symbol, Probability], dict[clingo.Symbol, Probability],
+                                                dict[tuple[DeltaTermCall, ...], set[clingo.Symbol]], bool]:
+    res = SmartRepeat.on(_worker_program[0], seed=seed)
+    exhausted, calls_prefixes = res._explore(calls_prefixes, times)
+    return *res._aggregates(), calls_prefixes, exhausted
 
 
 @typeguard.typechecked
@@ -116,91 +605,352 @@ class Repeat:
     _number_of_calls: list[int] = dataclasses.field(default_factory=lambda: [0], init=False)
     _counters: Dict[tuple[DeltaTermCall, ...], int]
     key: InitVar[object]
+    workers: int = dataclasses.field(default=1)
+    seed: Optional[int] = dataclasses.field(default=None)
+    top_size: int = dataclasses.field(default=20)
+    _number_of_shards: list[int] = dataclasses.field(default_factory=lambda: [0], init=False)
+    _executor: list[ProcessPoolExecutor] = dataclasses.field(default_factory=list, init=False)
+    # the stable models of each outcome are kept here (rather than in the cache of the program, which may evict them)
+    _outcomes: Dict[tuple[DeltaTermCall, ...], Fingerprint] = dataclasses.field(default_factory=dict, init=False)
+    _models: Dict[Fingerprint, ModelList] = dataclasses.field(default_factory=dict, init=False)
+    # weights of the sets of stable models, updated by each sample
+    _frequencies: FrequencyTable = dataclasses.field(default=None, init=False)
+    # weights of brave and cautious consequences, by id in the symbol table of the program
+    _brave: Dict[int, Any] = dataclasses.field(default_factory=dict, init=False)
+    _cautious: Dict[int, Any] = dataclasses.field(default_factory=dict, init=False)
 
     __key = object()
 
     def __post_init__(self, key):
         validate('key', key, equals=self.__key, help_msg="Must be created by Repeat::on()")
+        validate('workers', self.workers, min_value=1)
+        object.__setattr__(self, '_frequencies', FrequencyTable(self.top_size))
+        if self.workers == 1:
+            if self.seed is not None:
+                delta_terms_module.seed(self.seed)
+        elif self.seed is None:
+            object.__setattr__(self, 'seed', int(numpy.random.SeedSequence().entropy))
 
     @staticmethod
-    def on(program: Program, times: Optional[int] = None, smart=False) -> 'Repeat | SmartRepeat':
-        if smart:
-            res = SmartRepeat(program=program, _counters=defaultdict(lambda: 0), key=Repeat.__key)
+    def on(program: Program, times: Optional[int] = None, smart=False, workers: int = 1,
+           seed: Optional[int] = None, systematic=False, coverage: Optional[Probability] = None,
+           best_first=False, time_budget: Optional[float] = None, streaming=False,
+           top_size: int = 20) -> 'Repeat | SmartRepeat | SystematicRepeat | StreamingRepeat':
+        """
+        Create a Repeat (or a SmartRepeat if smart is True) for the given program, and possibly repeat it.
+
+        If streaming is True, a StreamingRepeat is created instead, which folds each sample into running aggregates
+        and discards its trace (smart and systematic enumeration need the traces, and cannot be streamed).
+
+        The top_size most frequent sets of stable models are tracked while sampling (see
+        top_sets_of_stable_models_frequency()).
+
+        If systematic is True, a SystematicRepeat is created instead, which stops when the explored outcomes cover
+        the given probability mass (by default, when all outcomes are explored) or when the time budget runs out.
+        Prefixes are explored depth-first, or best-first (by probability) if best_first is True.
+
+        If workers is greater than 1, samples are sharded across a pool of worker processes, each shard using an
+        independent random stream derived from seed (so that runs with the same seed and workers are reproducible).
+        For smart enumeration, shards are disjoint subtrees of the delta terms, so that each outcome is still
+        explored at most once.
+        """
+        validate('streaming', streaming and (smart or systematic), equals=False,
+                 help_msg="Smart and systematic enumeration cannot be streamed")
+        if systematic:
+            res = SystematicRepeat(program=program, _counters=defaultdict(lambda: 0), key=Repeat.__key,
+                                   workers=workers, seed=seed, coverage=coverage or Probability.of(1),
+                                   best_first=best_first, time_budget=time_budget, top_size=top_size)
+        elif streaming:
+            res = StreamingRepeat(program=program, key=Repeat.__key, workers=workers, seed=seed,
+                                  top_size=top_size)
+        elif smart:
+            res = SmartRepeat(program=program, _counters=defaultdict(lambda: 0), key=Repeat.__key, workers=workers,
+                              seed=seed, top_size=top_size)
         else:
-            res = Repeat(program=program, _counters=defaultdict(lambda: 0), key=Repeat.__key)
+            res = Repeat(program=program, _counters=defaultdict(lambda: 0), key=Repeat.__key, workers=workers,
+                         seed=seed, top_size=top_size)
         if times is not None:
             validate('times', times, min_value=1)
             res.repeat(times)
         return res
 
+    def close(self) -> None:
+        """
+        Shutdown the pool of worker processes (if any).
+        """
+        for executor in self._executor:
+            executor.shutdown()
+        self._executor.clear()
+
+    def _shard_seed(self) -> int:
+        self._number_of_shards[0] += 1
+        sequence = numpy.random.SeedSequence(self.seed, spawn_key=(self._number_of_shards[0],))
+        return int(sequence.generate_state(1)[0])
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if not self._executor:
+            # the caller may be multi-threaded (e.g., the refresh thread of the CLI), and forking it may deadlock the
+            # workers: they are forked by a single-threaded server process instead, which imports this module once
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload([__name__])
+            executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                           initargs=(self.program, Probability.backend()), mp_context=context)
+            weakref.finalize(self, executor.shutdown, wait=False, cancel_futures=True)
+            self._executor.append(executor)
+        return self._executor[0]
+
     @property
     def number_of_calls(self):
         return self._number_of_calls[0]
 
-    def repeat(self, times: int):
+    def repeat(self, times: int, on_sample: Optional[Callable[[SmsResult], None]] = None):
+        """
+        Run the program the given number of times, possibly passing each result to on_sample (e.g., to stream it).
+        """
         validate('times', times, min_value=1)
+        if self.workers > 1:
+            validate('on_sample', on_sample is None, equals=True,
+                     help_msg="Samples of worker processes cannot be observed")
+            self.__repeat_in_parallel(times)
+            return
         for _ in range(times):
-            res = self.program.sms()
-            self._counters[res.delta_terms] += 1
+            res = self._sample()
+            self._count(res)
             self._number_of_calls[0] += 1
+            if on_sample is not None:
+                on_sample(res)
+
+    def _sample(self) -> SmsResult:
+        return self.program.sms()
+
+    def _count(self, res: SmsResult) -> None:
+        self._counters[res.delta_terms] += 1
+        if res.delta_terms not in self._outcomes:
+            self._outcomes[res.delta_terms] = res.models.fingerprint
+            self._models.setdefault(res.models.fingerprint, res.models)
+        weight = self._weight_of(res.delta_terms, 1)
+        self._frequencies.add(self._outcomes[res.delta_terms], weight)
+        self._count_consequences(res.models, weight)
+
+    def _count_consequences(self, models: ModelList, weight) -> None:
+        if not models:
+            return
+        if self.program.consequences is not None:
+            # the only model is the set of consequences computed by the solver
+            for atom in models.ids(0):
+                self.__add(self._brave if self.program.consequences == "brave" else self._cautious, atom, weight)
+            return
+        brave, cautious = set(models.ids(0)), set(models.ids(0))
+        for index in range(1, len(models)):
+            brave.update(models.ids(index))
+            cautious.intersection_update(models.ids(index))
+        for atom in brave:
+            self.__add(self._brave, atom, weight)
+        for atom in cautious:
+            self.__add(self._cautious, atom, weight)
+
+    @staticmethod
+    def __add(weights: dict, key, weight) -> None:
+        weights[key] = weights[key] + weight if key in weights else weight
+
+    def _consequences(self) -> tuple[Dict[clingo.Symbol, Any], Dict[clingo.Symbol, Any]]:
+        symbols = self.program.symbols
+        return {symbols.symbol(key): value for key, value in self._brave.items()}, \
+            {symbols.symbol(key): value for key, value in self._cautious.items()}
+
+    def _merge_consequences(self, brave: Dict[clingo.Symbol, Any], cautious: Dict[clingo.Symbol, Any]) -> None:
+        symbols = self.program.symbols
+        for key, value in brave.items():
+            self.__add(self._brave, symbols.intern(key), value)
+        for key, value in cautious.items():
+            self.__add(self._cautious, symbols.intern(key), value)
+
+    def _aggregates(self) -> tuple:
+        # what a worker process sends back, to be given to _merge() (models and atoms as symbols, as ids are local)
+        return dict(self._counters), self._outcomes, {key: _to_symbols(value) for key, value in self._models.items()}, \
+            *self._consequences()
+
+    def _merge(self, counters: Dict[tuple[DeltaTermCall, ...], int],
+               outcomes: Dict[tuple[DeltaTermCall, ...], Fingerprint], models: Dict[Fingerprint, Optional[tuple]],
+               brave: Dict[clingo.Symbol, Any], cautious: Dict[clingo.Symbol, Any]) -> None:
+        # fingerprints computed by other processes are replaced by the ones of the models interned here
+        interned = {key: _of_symbols(value, self.program.symbols) for key, value in models.items()}
+        for key, value in counters.items():
+            self._counters[key] += value
+        for key, value in outcomes.items():
+            self._outcomes.setdefault(key, interned[value].fingerprint)
+        for value in interned.values():
+            self._models.setdefault(value.fingerprint, value)
+        for key, value in counters.items():
+            self._frequencies.add(self._outcomes[key], self._weight_of(key, value))
+        self._merge_consequences(brave, cautious)
+
+    def _models_of(self, delta_terms: tuple[DeltaTermCall, ...]) -> ModelList:
+        return self._models[self._outcomes[delta_terms]]
+
+    def merge(self, aggregates: tuple, times: int) -> None:
+        """
+        Merge the aggregates (see _aggregates()) of times runs of the same program performed by another process.
+        """
+        self._merge(*aggregates)
+        self._number_of_calls[0] += times
+
+    def __repeat_in_parallel(self, times: int):
+        shards = [times // self.workers + (1 if index < times % self.workers else 0) for index in range(self.workers)]
+        shards = [shard for shard in shards if shard]
+        futures = [self._pool().submit(_repeat_in_worker, shard, self._shard_seed(), isinstance(self, StreamingRepeat))
+                   for shard in shards]
+        for shard, future in zip(shards, futures):
+            self.merge(future.result(), shard)
 
     def no_stable_model_frequency(self):
-        freq = Probability()
-        for key in self._counters:
-            res = self.program.sms(delta_terms=key)
-            if res.models.is_emtpy():
-                freq += self._probability_of(key)
-        return freq
+        return Probability.sum_of(self._frequency_of(weight) for key, weight in self._frequencies.items()
+                                  if self._models[key].is_emtpy() and not self._models[key].is_timed_out())
+
+    def timed_out_frequency(self):
+        return Probability.sum_of(self._frequency_of(weight) for key, weight in self._frequencies.items()
+                                  if self._models[key].is_timed_out())
 
     def sets_of_stable_models_frequency(self):
-        frequency = defaultdict(lambda: Probability())
-        models = {}
-        for key in self._counters:
-            res = self.program.sms(delta_terms=key)
-            models_as_str = str(res.models)
-            frequency[models_as_str] += self._probability_of(key)
-            models[models_as_str] = res.models
-        return SetsOfStableModelsFrequency(frequency, models)
+        frequency = {key: self._frequency_of(weight) for key, weight in self._frequencies.items()}
+        return SetsOfStableModelsFrequency(frequency, {key: self._models[key] for key in frequency})
+
+    def top_sets_of_stable_models_frequency(self) -> list[tuple[Probability, ModelList]]:
+        """
+        Return the (at most top_size) most frequent sets of stable models, by decreasing frequency.
+
+        The unexplored probability mass of smart enumeration, if any, is also reported (as in
+        sets_of_stable_models_frequency()).
+        """
+        res = [(self._frequency_of(weight), self._models[key]) for key, weight in self._frequencies.top()]
+        total = Probability() if self._frequencies.total is None else self._frequency_of(self._frequencies.total)
+        if total < Probability.of(1, 1) and not total.complement().is_negligible():
+            res.append((total.complement(), ModelList.unexplored()))
+            res.sort(key=lambda item: item[0], reverse=True)
+        return res
+
+    @property
+    def number_of_sets_of_stable_models(self) -> int:
+        return len(self._frequencies)
+
+    def atom_marginals(self, predicates: Optional[Iterable[str]] = None,
+                       confidence: float = 0.95) -> Dict[GroundAtom | int | str, AtomMarginal]:
+        """
+        Map each atom to the frequency of the samples having it as a brave and as a cautious consequence.
+
+        Atoms can be restricted to the given predicates (each one given as name or name/arity).
+        Counters are updated while sampling, so that the models are not inspected here.
+        If the program computes only brave (cautious) consequences, the cautious (brave) frequencies are None.
+        Timed out samples are not counted, as their consequences are unknown.
+        """
+        validate('confidence', confidence, min_value=0, max_value=1)
+        predicates = None if predicates is None else set(predicates)
+        symbols = self.program.symbols
+        res = {}
+        # with consequences, the program computes only one kind of consequences
+        consequences = self.program.consequences
+        atoms = self._cautious if consequences == "cautious" else self._brave
+        decided = self.timed_out_frequency().complement()
+        for atom in atoms:
+            element = symbols.element(atom)
+            if predicates is not None and not (
+                    type(element) is GroundAtom and
+                    (element.predicate_name in predicates or
+                     f"{element.predicate_name}/{element.predicate_arity}" in predicates)):
+                continue
+            brave = None if consequences == "cautious" else self._frequency_of(self._brave[atom]) / decided
+            cautious = None if consequences == "brave" else \
+                self._frequency_of(self._cautious[atom]) / decided if atom in self._cautious else Probability()
+            res[element] = AtomMarginal(brave, cautious,
+                                        None if brave is None else self._interval(brave, confidence, decided),
+                                        None if cautious is None else self._interval(cautious, confidence, decided))
+        return res
+
+    def _interval(self, frequency: Probability, confidence: float, decided: Probability) -> tuple[float, float]:
+        # only the samples that did not time out (a fraction decided of the calls) are counted
+        return _wilson_interval(float(frequency), round(self.number_of_calls * float(decided)), confidence)
 
     def stable_models_frequency_under_uniform_distribution(self):
-        frequency = defaultdict(lambda: Probability())
-        models = {}
-        for key in self._counters:
-            res = self.program.sms(delta_terms=key)
-            if res.models:
-                for model in res.models:
-                    model_as_str = str(model)
-                    frequency[model_as_str] += Probability.of(self._counters[key],
-                                                              len(res.models) * self.number_of_calls)
-                    models[model_as_str] = ModelList.of([model])
-            else:
-                frequency['INCOHERENT'] += self._probability_of(key)
-                models['INCOHERENT'] = ModelList.of([])
-        return SetsOfStableModelsFrequency(frequency, models)
+        return _stable_models_frequency_under_uniform_distribution(
+            (self._models_of(key), self._probability_of(key)) for key in self._counters)
 
     def _probability_of(self, delta_terms):
         return Probability.of(self._counters[delta_terms], self.number_of_calls)
 
+    def _weight_of(self, delta_terms: tuple[DeltaTermCall, ...], count: int):
+        # the weight of count samples with the given delta terms in the frequency table
+        return count
+
+    def _frequency_of(self, weight) -> Probability:
+        return Probability.of(weight, self.number_of_calls)
+
+
+@typeguard.typechecked
+@dataclasses.dataclass(frozen=True)
+class StreamingRepeat(Repeat):
+    """
+    A Repeat that keeps running aggregates rather than the traces of the samples.
+
+    Each sample increments the counter of its set of stable models, and the counters of its brave consequences (atoms
+    in some stable model) and cautious consequences (atoms in all stable models; incoherent samples have none).
+    Memory is linear in the number of distinct sets of stable models and atoms, not in the number of distinct traces.
+    For this reason, results are added to the cache of the program only if it is bounded in memory (by cache_size, and
+    without spilling to disk, as the traces of spilled results are kept in memory).
+    """
+    # samples are not counted by trace
+    _counters: Dict[tuple[DeltaTermCall, ...], int] = dataclasses.field(default_factory=dict, init=False)
+
+    def _sample(self) -> SmsResult:
+        program = self.program
+        return program.sms(record=program.cache_size > 0 and program.cache_directory is None)
+
+    def _count(self, res: SmsResult) -> None:
+        self._frequencies.add(res.models.fingerprint, 1)
+        self._models.setdefault(res.models.fingerprint, res.models)
+        self._count_consequences(res.models, 1)
+
+    def _aggregates(self) -> tuple:
+        return dict(self._frequencies.items()), {key: _to_symbols(value) for key, value in self._models.items()}, \
+            *self._consequences()
+
+    def _merge(self, sets_counters: Dict[Fingerprint, int], models: Dict[Fingerprint, Optional[tuple]],
+               brave: Dict[clingo.Symbol, int], cautious: Dict[clingo.Symbol, int]) -> None:
+        interned = {key: _of_symbols(value, self.program.symbols) for key, value in models.items()}
+        for key, value in sets_counters.items():
+            self._frequencies.add(interned[key].fingerprint, value)
+        for value in interned.values():
+            self._models.setdefault(value.fingerprint, value)
+        self._merge_consequences(brave, cautious)
+
+    def stable_models_frequency_under_uniform_distribution(self):
+        return _stable_models_frequency_under_uniform_distribution(
+            (self._models[key], self._frequency_of(value)) for key, value in self._frequencies.items())
+
 
 @typeguard.typechecked
 @dataclasses.dataclass(frozen=True)
 class SmartRepeat(Repeat):
     __calls_prefixes: Dict[tuple[DeltaTermCall, ...], set[clingo.Symbol]] = dataclasses.field(
         default_factory=dict, init=False)
+    __subtrees: list[Dict[tuple[DeltaTermCall, ...], set[clingo.Symbol]]] = dataclasses.field(
+        default_factory=list, init=False)
+
+    __SUBTREES_PER_WORKER = 4
 
     @staticmethod
-    def on(program: Program, times: Optional[int] = None, smart=True) -> 'SmartRepeat':
+    def on(program: Program, times: Optional[int] = None, smart=True, workers: int = 1,
+           seed: Optional[int] = None) -> 'SmartRepeat':
         validate('smart', smart, equals=True, help_msg="SmartRepeat::on() must be called with smart=True")
-        return Repeat.on(program, times, smart)
-
+        return Repeat.on(program, times, smart, workers, seed)
 
     def repeat(self, times: int) -> bool:
         validate('times', times, min_value=1)
+        if self.workers > 1:
+            return self.__repeat_in_parallel(times)
         for index in range(times):
             res = self.program.sms(calls_prefixes=self.__calls_prefixes)
-            validate("unnamed delta terms only", all(delta_term.function == "" for delta_term in res.delta_terms),
-                     equals=True, help_msg="Smart enumeration is incompatible with named delta terms")
-            self._counters[res.delta_terms] += 1
+            _validate_unnamed(res.delta_terms)
+            self._count(res)
             self._number_of_calls[0] += 1
             assert self._counters[res.delta_terms] == 1  # we cannot encounter the same ground program twice
             if not res.delta_terms:
@@ -216,5 +966,135 @@ class SmartRepeat(Repeat):
             self.__calls_prefixes[key].add(res.delta_terms[last - 1].result)
         return False
 
+    def _explore(self, calls_prefixes: Dict[tuple[DeltaTermCall, ...], set[clingo.Symbol]],
+                 times: int) -> tuple[bool, Dict[tuple[DeltaTermCall, ...], set[clingo.Symbol]]]:
+        self.__calls_prefixes.update(calls_prefixes)
+        return self.repeat(times), self.__calls_prefixes
+
+    def __split(self) -> list[Dict[tuple[DeltaTermCall, ...], set[clingo.Symbol]]]:
+        """
+        Split the tree of delta terms in disjoint subtrees, each one identified by the calls prefixes forcing its root.
+
+        Levels of the tree are expanded until there are enough subtrees to keep all workers busy.
+        """
+        frontier, leaves = [()], []
+        while frontier and len(frontier) + len(leaves) < self.workers * self.__SUBTREES_PER_WORKER:
+            next_frontier = []
+            for prefix in frontier:
+                res = self.program.sms(calls_prefixes=_forcing(prefix))
+                _validate_unnamed(res.delta_terms)
+                if len(res.delta_terms) == len(prefix):
+                    leaves.append(prefix)
+                    continue
+                next_frontier.extend(prefix + (call,) for call in _branches(res.delta_terms[len(prefix)]))
+            frontier = next_frontier
+        return [_forcing(prefix) for prefix in leaves + frontier]
+
+    def __repeat_in_parallel(self, times: int) -> bool:
+        if self.number_of_calls == 0 and not self.__subtrees:
+            self.__subtrees.extend(self.__split())
+        subtrees = self.__subtrees[:times]
+        shards = [times // len(subtrees) + (1 if index < times % len(subtrees) else 0)
+                  for index in range(len(subtrees))]
+        futures = [self._pool().submit(_smart_repeat_in_worker, calls_prefixes, shard, self._shard_seed())
+                   for calls_prefixes, shard in zip(subtrees, shards)]
+        not_exhausted = []
+        for future in futures:
+            *aggregates, calls_prefixes, exhausted = future.result()
+            self._merge(*aggregates)
+            self._number_of_calls[0] += sum(aggregates[0].values())
+            if not exhausted:
+                not_exhausted.append(calls_prefixes)
+        self.__subtrees[:len(subtrees)] = not_exhausted
+        return not self.__subtrees
+
     def _probability_of(self, delta_terms):
         return reduce(lambda p, d: p * d.probability, delta_terms, Probability.of(1, 1))
+
+    def _weight_of(self, delta_terms: tuple[DeltaTermCall, ...], count: int):
+        # each outcome is explored once, and weighs its probability
+        return self._probability_of(delta_terms)
+
+    def _frequency_of(self, weight) -> Probability:
+        return weight
+
+    def _interval(self, frequency: Probability, confidence: float, decided: Probability) -> tuple[float, float]:
+        # frequencies are exact, but the unexplored outcomes may still contribute
+        total = Probability() if self._frequencies.total is None else self._frequencies.total
+        return float(frequency), min(1., float(frequency + total.complement() / decided))
+
+
+@typeguard.typechecked
+@dataclasses.dataclass(frozen=True)
+class SystematicRepeat(SmartRepeat):
+    """
+    Enumerate the outcomes of the delta terms systematically, using an explicit collection of prefixes to be explored.
+
+    Each call to the solver forces the delta terms of a prefix and completes it with the most probable outcomes, so
+    that each outcome is explored exactly once.
+    The alternatives of the completed delta terms are added to the prefixes to be explored, and the next prefix is
+    the last added one (depth-first), or the most probable one if best_first is True.
+    Enumeration stops when the explored outcomes cover the given probability mass, or when the time budget (in
+    seconds) runs out.
+    """
+    coverage: Probability = dataclasses.field(default=Probability.of(1))
+    best_first: bool = dataclasses.field(default=False)
+    time_budget: Optional[float] = dataclasses.field(default=None)
+    __pending: list[tuple[Fraction | float, int, tuple[DeltaTermCall, ...]]] = dataclasses.field(
+        default_factory=lambda: [(Fraction(0), 0, ())], init=False)
+    __pushed: list[int] = dataclasses.field(default_factory=lambda: [0], init=False)
+    __covered: list[Probability] = dataclasses.field(default_factory=lambda: [Probability()], init=False)
+    __deadline: list[float] = dataclasses.field(default_factory=list, init=False)
+
+    def __post_init__(self, key):
+        super().__post_init__(key)
+        validate('workers', self.workers, equals=1, help_msg="Systematic enumeration does not support workers")
+        if self.time_budget is not None:
+            validate('time_budget', self.time_budget, min_value=0)
+
+    @staticmethod
+    def on(program: Program, times: Optional[int] = None, smart=True, workers: int = 1,
+           seed: Optional[int] = None, systematic=True, coverage: Optional[Probability] = None,
+           best_first=False, time_budget: Optional[float] = None) -> 'SystematicRepeat':
+        validate('systematic', systematic, equals=True,
+                 help_msg="SystematicRepeat::on() must be called with systematic=True")
+        return Repeat.on(program, times, smart, workers, seed, systematic, coverage, best_first, time_budget)
+
+    @property
+    def covered(self) -> Probability:
+        return self.__covered[0]
+
+    @property
+    def unexplored(self) -> Probability:
+        return self.covered.complement()
+
+    def __push(self, prefix: tuple[DeltaTermCall, ...]) -> None:
+        priority = -self._probability_of(prefix).value if self.best_first else Fraction(0)
+        # ties are broken in favor of the last added prefix
+        self.__pushed[0] += 1
+        heapq.heappush(self.__pending, (priority, -self.__pushed[0], prefix))
+
+    def __done(self) -> bool:
+        return not self.__pending or self.covered >= self.coverage or \
+            (bool(self.__deadline) and time.monotonic() >= self.__deadline[0])
+
+    def repeat(self, times: int) -> bool:
+        validate('times', times, min_value=1)
+        if self.time_budget is not None and not self.__deadline:
+            self.__deadline.append(time.monotonic() + self.time_budget)
+        for _ in range(times):
+            if self.__done():
+                break
+            _, _, prefix = heapq.heappop(self.__pending)
+            res = self.program.sms(calls_prefixes=_forcing(prefix), most_probable=True)
+            _validate_unnamed(res.delta_terms)
+            self._count(res)
+            self._number_of_calls[0] += 1
+            self.__covered[0] += self._probability_of(res.delta_terms)
+            # deeper (and more probable) alternatives are pushed last, so that they are explored first
+            for index in range(len(prefix), len(res.delta_terms)):
+                call = res.delta_terms[index]
+                for branch in sorted(_branches(call), key=lambda branch: branch.probability):
+                    if branch.result != call.result:
+                        self.__push(res.delta_terms[:index] + (branch,))
+        return self.__done()
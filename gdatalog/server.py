@@ -1,18 +1,188 @@
+import asyncio
+import contextlib
+import hashlib
+import json as json_module
+import multiprocessing
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Awaitable, Callable, Optional
+
 import clingo
+import numpy
 from dumbo_asp.primitives.atoms import GroundAtom
+from dumbo_utils.validation import validate
 from fastapi import FastAPI
 from fastapi import Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from gdatalog import delta_terms
+from gdatalog.delta_terms import Probability
+from gdatalog.program import Program, Repeat
+
+
+# the server is started by uvicorn from an import string, so that it is configured by environment variables
+WORKERS = int(os.environ.get("GDATALOG_SERVER_WORKERS", os.cpu_count() or 1))
+MAX_PENDING = int(os.environ.get("GDATALOG_SERVER_MAX_PENDING", 4 * WORKERS))
+TIMEOUT = float(os.environ.get("GDATALOG_SERVER_TIMEOUT", 30))
+PROGRAM_CACHE_BYTES = int(os.environ.get("GDATALOG_SERVER_PROGRAM_CACHE_BYTES", 64 * 2**20))
+PROGRAM_CACHE_RESULTS = int(os.environ.get("GDATALOG_SERVER_PROGRAM_CACHE_RESULTS", 1000))
+DISCONNECT_POLLING_INTERVAL = 0.1
+# fraction of the timeout left to a worker to return the partial results of a repeat (or batch)
+DEADLINE_MARGIN = 0.1
+
+
+class ProgramCache:
+    """
+    Cache of prepared Programs by hash of their source and options (the least recently used ones are evicted first).
+
+    The memory of the cache is bounded by max_bytes, estimated for each program by size() when the cache is accessed
+    (programs grow while used, as they cache results and intern symbols), while the results cached by each program are
+    also bounded by max_results_per_program.
+    """
+    # estimated memory of a program besides its source (mostly parsed statements, held by clingo), of each byte of its
+    # source, and of each symbol in its table (which never shrinks), measured on CPython
+    PROGRAM_BYTES = 16 * 1024
+    SOURCE_BYTES = 16
+    SYMBOL_BYTES = 160
+
+    def __init__(self, max_bytes: int, max_results_per_program: int):
+        validate('max_bytes', max_bytes, min_value=0, help_msg="Use 0 to disable the cache")
+        validate('max_results_per_program', max_results_per_program, min_value=1)
+        self.__programs: OrderedDict[str, Program] = OrderedDict()
+        self.__max_bytes = max_bytes
+        self.__max_results_per_program = max_results_per_program
+
+    @staticmethod
+    def key(code: str, max_stable_models: int, solve_timeout: Optional[float]) -> str:
+        return hashlib.sha256(repr((code, max_stable_models, solve_timeout)).encode()).hexdigest()
+
+    @staticmethod
+    def size(program: Program) -> int:
+        return ProgramCache.PROGRAM_BYTES + ProgramCache.SOURCE_BYTES * len(program.code.encode()) + \
+            ProgramCache.SYMBOL_BYTES * len(program.symbols) + program.cached_results_bytes
+
+    def __len__(self):
+        return len(self.__programs)
+
+    @property
+    def bytes(self) -> int:
+        return sum(self.size(program) for program in self.__programs.values())
+
+    def get(self, code: str, max_stable_models: int, solve_timeout: Optional[float]) -> tuple[Program, bool]:
+        """
+        Return the program for the given source and options, and whether it was cached (otherwise, it is prepared and
+        possibly cached).
+        """
+        key = self.key(code, max_stable_models, solve_timeout)
+        cached = key in self.__programs
+        if cached:
+            self.__programs.move_to_end(key)
+            program = self.__programs[key]
+        else:
+            program = Program(code, max_stable_models=max_stable_models, cache_size=self.__max_results_per_program,
+                              solve_timeout=solve_timeout)
+            self.__programs[key] = program
+        # sizes are estimated again, as programs grew while used by the previous tasks (the returned program may be
+        # evicted as well, if it does not fit alone)
+        size = self.bytes
+        while size > self.__max_bytes:
+            _, evicted = self.__programs.popitem(last=False)
+            size -= self.size(evicted)
+        return program, cached
+
+
+_program_cache: list[ProgramCache] = []
+
+
+def _init_worker(probability_backend: str, program_cache_bytes: int, program_cache_results: int) -> None:
+    delta_terms.seed()
+    _program_cache[:] = [ProgramCache(program_cache_bytes, program_cache_results)]
+    Probability.set_backend(probability_backend)
+
+
+class SolverPool:
+    """
+    A bounded pool of worker processes solving programs, so that the event loop of the server is never blocked.
+
+    At most max_pending requests are queued or running: further requests must be rejected by the caller (see
+    saturated), so that a burst of clients cannot grow the queue without bounds.
+    """
+    def __init__(self, workers: int, max_pending: int):
+        validate('workers', workers, min_value=1)
+        validate('max_pending', max_pending, min_value=1)
+        self.__workers = workers
+        self.__max_pending = max_pending
+        self.__pending = 0
+        self.__lock = threading.Lock()
+        self.__executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def pending(self) -> int:
+        return self.__pending
+
+    @property
+    def saturated(self) -> bool:
+        return self.__pending >= self.__max_pending
 
-from gdatalog.program import Program
+    def __start(self) -> ProcessPoolExecutor:
+        if self.__executor is None:
+            # the server is multi-threaded, and forking it may deadlock the workers: they are forked by a
+            # single-threaded server process instead, which imports the modules only once
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload([__name__])
+            self.__executor = ProcessPoolExecutor(max_workers=self.__workers, initializer=_init_worker,
+                                                  initargs=(Probability.backend(), PROGRAM_CACHE_BYTES,
+                                                            PROGRAM_CACHE_RESULTS), mp_context=context)
+        return self.__executor
 
+    def submit(self, function: Callable, *args) -> Future:
+        validate('saturated', self.saturated, equals=False, help_msg="Too many pending requests")
+        with self.__lock:
+            self.__pending += 1
+        try:
+            try:
+                future = self.__start().submit(function, *args)
+            except BrokenProcessPool:
+                # a worker died (e.g., killed for lack of memory), and the pool is replaced by a new one
+                self.shutdown()
+                future = self.__start().submit(function, *args)
+        except BaseException:
+            self.__done(None)
+            raise
+        future.add_done_callback(self.__done)
+        return future
 
-app = FastAPI()
+    def __done(self, _: Optional[Future]) -> None:
+        # called by the thread of the executor, when the task is completed or cancelled (or if it is not submitted)
+        with self.__lock:
+            self.__pending -= 1
+
+    def shutdown(self) -> None:
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False, cancel_futures=True)
+            self.__executor = None
+
+
+@contextlib.asynccontextmanager
+async def lifespan(application: FastAPI):
+    application.state.pool = SolverPool(WORKERS, MAX_PENDING)
+    application.state.metrics = Counter()
+    yield
+    application.state.pool.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[],
     allow_credentials=False,
-    allow_methods=["POST"],
+    allow_methods=["GET", "POST"],
     allow_headers=["*"],
 )
 
@@ -42,22 +212,277 @@ def atom_to_json(atom: GroundAtom):
     }
 
 
+@contextlib.contextmanager
+def _seeded(seed: Optional[int]):
+    # a seeded request must not make the following (unseeded) requests served by the same worker predictable
+    if seed is None:
+        yield
+        return
+    delta_terms.seed(seed)
+    try:
+        yield
+    finally:
+        delta_terms.seed()
+
+
+def _sms_to_json(sms) -> dict:
+    return {
+        "state": "TIMED OUT" if sms.models.is_timed_out() else str(sms.state),
+        "models": [[atom_to_json(atom) for atom in model] for model in sms.models],
+        "delta_terms": [str(delta_term) for delta_term in sms.delta_terms],
+    }
+
+
+def _models_to_json(probability: Probability, models) -> dict:
+    return {
+        "probability": float(probability),
+        "str": str(probability),
+        "unexplored": models.is_unexplored(),
+        "timed_out": models.is_timed_out(),
+        "models": [[atom_to_json(atom) for atom in model] for model in models],
+    }
+
+
+# functions executed by a worker process, returning also the accesses to the cache of programs (hit or miss);
+# the search is bounded there too, as running tasks cannot be cancelled, and tasks made of several runs stop at a
+# deadline (see _deadline()) so that their partial results are returned before the timeout of the request
+
+def _deadline() -> float:
+    # the time spent by a task waiting for a worker counts towards the timeout of its request, so that the deadline is
+    # fixed on submission (as wall-clock time, to be compared by another process)
+    return time.time() + TIMEOUT * (1 - DEADLINE_MARGIN)
+
+
+def _run(code: str, max_stable_models: int, timeout: float, seed: Optional[int]) -> tuple[dict, list[bool]]:
+    program, cached = _program_cache[0].get(code, max_stable_models, timeout)
+    with _seeded(seed):
+        return _sms_to_json(program.sms()), [cached]
+
+
+def _run_batch(requests: list[tuple[str, int, Optional[int]]], timeout: float,
+               deadline: float) -> tuple[list[dict], list[bool]]:
+    res, accesses = [], []
+    for code, max_stable_models, seed in requests:
+        if time.time() >= deadline:
+            res.append({"error": f"Timeout after {timeout} seconds"})
+            continue
+        try:
+            sms, cached = _run(code, max_stable_models, timeout, seed)
+            res.append(sms)
+            accesses += cached
+        except Exception as e:
+            res.append({"error": str(e)})
+    return res, accesses
+
+
+def _repeat(code: str, max_stable_models: int, timeout: float, seed: Optional[int], times: int, smart: bool,
+            deadline: float) -> tuple[dict, list[bool]]:
+    program, cached = _program_cache[0].get(code, max_stable_models, timeout)
+    with _seeded(seed):
+        res = Repeat.on(program, smart=smart)
+        # the deadline is checked before each run, so that a slow program does not run past it (but for its last run)
+        while res.number_of_calls < times and time.time() < deadline:
+            if res.repeat(1):
+                break
+    if res.number_of_calls == 0:
+        return {"error": f"Timeout after {timeout} seconds"}, [cached]
+    frequency = res.sets_of_stable_models_frequency()
+    return {
+        "number_of_calls": res.number_of_calls,
+        "outcomes": [_models_to_json(probability, models)
+                     for probability, models in sorted(frequency.values(), key=lambda item: item[0], reverse=True)],
+    }, [cached]
+
+
+def _repeat_chunk(code: str, max_stable_models: int, timeout: float, seed: Optional[int], times: int,
+                  samples: bool, deadline: float) -> tuple[tuple[tuple, int, list[dict]], list[bool]]:
+    program, cached = _program_cache[0].get(code, max_stable_models, timeout)
+    res = Repeat.on(program, streaming=True)
+    chunk_samples = []
+    with _seeded(seed):
+        # as for _repeat(), the runs performed before the deadline are returned (with their number)
+        while res.number_of_calls < times and time.time() < deadline:
+            res.repeat(1, on_sample=(lambda sms: chunk_samples.append(_sms_to_json(sms))) if samples else None)
+    return (res._aggregates(), res.number_of_calls, chunk_samples), [cached]
+
+
+async def _disconnected(request: Request) -> None:
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLLING_INTERVAL)
+
+
+class Rejected(Exception):
+    """
+    A request that cannot be served by the solver pool, with its HTTP status.
+    """
+    def __init__(self, status_code: int, error: str):
+        super().__init__(error)
+        self.status_code = status_code
+
+    def response(self) -> Response:
+        return JSONResponse(status_code=self.status_code, content={"error": str(self)})
+
+
+async def _submit(request: Request, function: Callable, *args):
+    """
+    Run function in the solver pool, unless the pool is saturated (429), the timeout expires (504) or the client
+    disconnects (in these cases, the task is cancelled if not yet started).
+    """
+    pool: SolverPool = request.app.state.pool
+    if pool.saturated:
+        raise Rejected(429, "Too many pending requests, retry later")
+    result = asyncio.wrap_future(pool.submit(function, *args))
+    disconnected = asyncio.ensure_future(_disconnected(request))
+    try:
+        done, _ = await asyncio.wait({result, disconnected}, timeout=TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnected.cancel()
+    if result in done:
+        res, accesses = result.result()
+        # each worker has its own cache of programs, and their hits and misses are summed here
+        for cached in accesses:
+            request.app.state.metrics["program_cache_hits" if cached else "program_cache_misses"] += 1
+        return res
+    result.cancel()
+    if disconnected in done:
+        raise Rejected(499, "Client disconnected")
+    raise Rejected(504, f"Timeout after {TIMEOUT} seconds")
+
+
+async def _solve(request: Request, function: Callable, *args):
+    try:
+        return await _submit(request, function, *args)
+    except Rejected as e:
+        return e.response()
+
+
+async def _stream(request: Request, res: Repeat, run_chunk: Callable[[int], Awaitable[list[dict]]],
+                  first_samples: list[dict], times: int, update_frequency: int, sse: bool):
+    """
+    Yield the samples (if required) and a snapshot of the most frequent sets of stable models every update_frequency
+    runs, as lines of NDJSON or as server-sent events.
+
+    Runs are performed in chunks by the solver pool (run_chunk), and only their aggregates are kept here (in res).
+    The first chunk is run before the stream starts (so that errors of the program are reported as usual).
+    The stream ends early if the client disconnects, or with an error event if a chunk cannot be served.
+    """
+    def event(kind: str, data: dict) -> str:
+        line = json_module.dumps(jsonable_encoder({"type": kind, **data}))
+        return f"event: {kind}\ndata: {line}\n\n" if sse else f"{line}\n"
+
+    chunk_samples = first_samples
+    while True:
+        for sample in chunk_samples:
+            yield event("sample", sample)
+        yield event("snapshot", {
+            "number_of_calls": res.number_of_calls,
+            "number_of_outcomes": res.number_of_sets_of_stable_models,
+            "outcomes": [_models_to_json(probability, models)
+                         for probability, models in res.top_sets_of_stable_models_frequency()],
+        })
+        if res.number_of_calls >= times:
+            return
+        try:
+            chunk_samples = await run_chunk(min(update_frequency, times - res.number_of_calls))
+        except Rejected as e:
+            if e.status_code != 499:
+                yield event("error", {"error": str(e)})
+            return
+        except Exception as e:
+            yield event("error", {"error": str(e)})
+            return
+
+
+def _program_options(json: dict) -> tuple[str, int, Optional[int]]:
+    max_stable_models = int(json["max_stable_models"]) if "max_stable_models" in json else 1
+    seed = int(json["seed"]) if json.get("seed") is not None else None
+    return json["program"], max_stable_models, seed
+
+
 @app.post("/run/")
 async def _(request: Request):
+    """
+    Run a program once, or each program of a list (in a single task of the pool).
+    """
     json = await request.json()
     try:
-        max_stable_models = int(json["max_stable_models"]) if "max_stable_models" in json else 1
-        program = Program(json["program"], max_stable_models=max_stable_models)
+        if type(json) is list:
+            return await _solve(request, _run_batch, [_program_options(item) for item in json], TIMEOUT, _deadline())
+        code, max_stable_models, seed = _program_options(json)
+        return await _solve(request, _run, code, max_stable_models, TIMEOUT, seed)
+    except Exception as e:
+        return {
+            "error": str(e)
+        }
 
-        sms = program.sms()
 
+@app.post("/repeat/")
+async def _(request: Request):
+    """
+    Run a program several times (or with smart enumeration), and return the frequency of each set of stable models.
+
+    Runs stop shortly before the timeout of the request, and number_of_calls reports how many were performed (longer
+    runs should use /repeat/stream/).
+    """
+    json = await request.json()
+    try:
+        code, max_stable_models, seed = _program_options(json)
+        times = int(json["times"]) if "times" in json else 1000
+        validate('times', times, min_value=1)
+        smart = bool(json.get("smart", False))
+        return await _solve(request, _repeat, code, max_stable_models, TIMEOUT, seed, times, smart, _deadline())
+    except Exception as e:
         return {
-            "state": str(sms.state),
-            "models": [[atom_to_json(atom) for atom in model] for model in sms.models],
-            "delta_terms": [str(delta_term) for delta_term in sms.delta_terms],
+            "error": str(e)
         }
+
+
+@app.post("/repeat/stream/")
+async def _(request: Request):
+    """
+    Run a program several times, streaming snapshots of the frequencies (and possibly each sample) while running.
+    """
+    json = await request.json()
+    try:
+        code, max_stable_models, seed = _program_options(json)
+        times = int(json["times"]) if "times" in json else 1000
+        update_frequency = int(json["update_frequency"]) if "update_frequency" in json else 100
+        top_size = int(json["top_k"]) if "top_k" in json else 20
+        validate('times', times, min_value=1)
+        validate('update_frequency', update_frequency, min_value=1)
+        validate('top_k', top_size, min_value=1)
+        sse = json.get("format", "ndjson") == "sse" or "text/event-stream" in request.headers.get("accept", "")
+        samples = bool(json.get("samples", False))
+        # the program is prepared only by the workers, as merging the aggregates of the chunks only needs a table of
+        # symbols (here, the one of an empty program)
+        res = Repeat.on(Program(""), streaming=True, top_size=top_size)
+        seeds = numpy.random.SeedSequence(seed)
+
+        async def run_chunk(size: int) -> list[dict]:
+            chunk_seed = int(seeds.spawn(1)[0].generate_state(1)[0])
+            aggregates, number_of_calls, chunk_samples = await _submit(
+                request, _repeat_chunk, code, max_stable_models, TIMEOUT, chunk_seed, size, samples, _deadline())
+            if number_of_calls == 0:
+                raise Rejected(504, f"Timeout after {TIMEOUT} seconds")
+            res.merge(aggregates, number_of_calls)
+            return chunk_samples
+
+        first_samples = await run_chunk(min(update_frequency, times))
+        return StreamingResponse(
+            _stream(request, res, run_chunk, first_samples, times, update_frequency, sse),
+            media_type="text/event-stream" if sse else "application/x-ndjson",
+        )
+    except Rejected as e:
+        return e.response()
     except Exception as e:
         return {
             "error": str(e)
         }
 
+
+@app.get("/metrics/")
+async def _(request: Request):
+    return {
+        "pending": request.app.state.pool.pending,
+        **request.app.state.metrics,
+    }
@@ -1,8 +1,15 @@
+import copyreg
 import dataclasses
+import itertools
+import os
+import weakref
+from array import array
 from dataclasses import InitVar
-from typing import List, Iterable
+from typing import List, Iterable, Dict, Optional
 
+import clingo
 import typeguard
+from dumbo_asp.primitives.atoms import GroundAtom
 from dumbo_asp.primitives.models import Model
 from valid8 import validate
 
@@ -11,18 +18,117 @@ def on_model_print(m):
     print(m)
 
 
+def __reduce_symbol(symbol: clingo.Symbol):
+    # the internal representation of symbols is local to the process (e.g., a worker), so they are pickled as text
+    return clingo.parse_term, (str(symbol),)
+
+
+copyreg.pickle(clingo.Symbol, __reduce_symbol)
+
+
+class SymbolTable:
+    """
+    Interning of symbols (e.g., the shown atoms of the models of a Program) to consecutive integer ids.
+
+    Elements of models (atoms, numbers or strings) are built once per symbol, and only when a model is materialized.
+    Ids are local to the table: when pickled (e.g., to spill results to disk), a table is replaced by a reference that
+    is valid only in the same process.
+    Symbols are never removed (ids may still be held by ModelLists), so that a table grows with the distinct symbols
+    seen by its Program, even if the results of the Program are evicted from its cache.
+    """
+    __tables = weakref.WeakValueDictionary()
+    __next_token = itertools.count()
+
+    def __init__(self):
+        self.__ids: Dict[clingo.Symbol, int] = {}
+        self.__symbols: List[clingo.Symbol] = []
+        self.__elements: Dict[int, GroundAtom | int | str] = {}
+        self.__token = (os.getpid(), next(SymbolTable.__next_token))
+        SymbolTable.__tables[self.__token] = self
+
+    @staticmethod
+    def _of_token(token: tuple) -> "SymbolTable":
+        res = SymbolTable.__tables.get(token)
+        validate("token", res is not None, equals=True,
+                 help_msg="Symbol tables cannot be shared across processes; convert models to symbols instead")
+        return res
+
+    def __reduce__(self):
+        return SymbolTable._of_token, (self.__token,)
+
+    def __len__(self):
+        return len(self.__symbols)
+
+    def intern(self, symbol: clingo.Symbol) -> int:
+        res = self.__ids.get(symbol)
+        if res is None:
+            res = self.__ids[symbol] = len(self.__symbols)
+            self.__symbols.append(symbol)
+        return res
+
+    def symbol(self, symbol_id: int) -> clingo.Symbol:
+        return self.__symbols[symbol_id]
+
+    def element(self, symbol_id: int) -> GroundAtom | int | str:
+        res = self.__elements.get(symbol_id)
+        if res is None:
+            res = self.__elements[symbol_id] = Model.of_elements(self.__symbols[symbol_id], sort=False).value[0]
+        return res
+
+
+DEFAULT_SYMBOL_TABLE = SymbolTable()
+
+
+@dataclasses.dataclass(order=True, frozen=True)
+class Fingerprint:
+    """
+    Canonical identity of a model (its sorted atom ids) or of a list of models (the sorted fingerprints of its models).
+
+    The hash is computed once, so that fingerprints are cheap keys for aggregations.
+    Atom ids are local to a SymbolTable, and so are fingerprints: they must be recomputed for other tables.
+    """
+    value: tuple | bytes
+    __hash: int = dataclasses.field(default=0, init=False, compare=False, repr=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, '_Fingerprint__hash', hash(self.value))
+
+    def __hash__(self):
+        return self.__hash
+
+
 @typeguard.typechecked
 @dataclasses.dataclass(order=True, unsafe_hash=True, frozen=True)
 class ModelList:
-    __value: List[Model]
+    """
+    A list of models, each one stored as the sorted ids of its elements in a SymbolTable.
+
+    Model objects are materialized only on access, in the order of the models (as for printing), while ids and
+    fingerprints follow the order of the ids.
+    """
+    __value: List[array]
+    __symbols: SymbolTable = dataclasses.field(default=DEFAULT_SYMBOL_TABLE, compare=False)
     __unexplored: bool = dataclasses.field(default=False)
+    __timed_out: bool = dataclasses.field(default=False)
+    __fingerprint: Fingerprint = dataclasses.field(default=None, init=False, compare=False)
+    __order: Optional[tuple[int, ...]] = dataclasses.field(default=None, init=False, compare=False)
 
     key: InitVar[object] = dataclasses.field(default=...)
     __key = object
 
     @staticmethod
-    def of(models: Iterable[Model]):
-        return ModelList(list(models), key=ModelList.__key)
+    def of(models: Iterable[Model], symbols: SymbolTable = DEFAULT_SYMBOL_TABLE):
+        return ModelList.of_ids((array('I', sorted(symbols.intern(element) for element in ModelList.__symbols_of(model)))
+                                 for model in models), symbols)
+
+    @staticmethod
+    def of_ids(models: Iterable[array], symbols: SymbolTable):
+        return ModelList(list(models), symbols, key=ModelList.__key)
+
+    @staticmethod
+    def of_symbols(models: Iterable[Iterable[clingo.Symbol]], symbols: SymbolTable):
+        return ModelList.of_ids((array('I', sorted(symbols.intern(symbol) for symbol in model)) for model in models),
+                                symbols)
 
     @staticmethod
     def empty():
@@ -30,24 +136,82 @@ class ModelList:
 
     @staticmethod
     def unexplored():
-        return ModelList([], True, key=ModelList.__key)
+        return ModelList([], DEFAULT_SYMBOL_TABLE, True, key=ModelList.__key)
+
+    @staticmethod
+    def timed_out():
+        return ModelList([], DEFAULT_SYMBOL_TABLE, False, True, key=ModelList.__key)
+
+    @staticmethod
+    def __symbols_of(model: Model) -> Iterable[clingo.Symbol]:
+        for element in model:
+            if type(element) is GroundAtom:
+                yield element.value
+            elif type(element) is int:
+                yield clingo.Number(element)
+            else:
+                yield clingo.String(element)
 
     def __post_init__(self, key):
         validate("key", key, equals=self.__key, help_msg="ModelList must be created using the static factory methods")
         validate("unexplored", self.__unexplored and len(self.__value) > 0, equals=False, help_msg="A ModelList cannot be both unexplored and non-empty")
+        validate("timed_out", self.__timed_out and (self.__unexplored or len(self.__value) > 0), equals=False,
+                 help_msg="A timed out ModelList cannot be unexplored or non-empty")
+        # ids of each model are sorted, and so models can be sorted (and identified) by their ids
         self.__value.sort()
+        object.__setattr__(self, '_ModelList__fingerprint',
+                           Fingerprint((self.__unexplored, self.__timed_out) +
+                                       tuple(model.tobytes() for model in self.__value)))
+
+    @property
+    def fingerprint(self) -> Fingerprint:
+        return self.__fingerprint
+
+    @property
+    def model_fingerprints(self) -> tuple[Fingerprint, ...]:
+        return tuple(Fingerprint(model.tobytes()) for model in self.__value)
+
+    @property
+    def symbols(self) -> SymbolTable:
+        return self.__symbols
+
+    def ids(self, index: int) -> array:
+        return self.__value[index]
+
+    def sublist(self, index: int) -> "ModelList":
+        return ModelList.of_ids([self.__value[index]], self.__symbols)
+
+    def to_symbols(self) -> tuple[tuple[clingo.Symbol, ...], ...]:
+        """
+        Return the models as tuples of symbols, which are independent of the SymbolTable (e.g., to send to other
+        processes).
+        """
+        return tuple(tuple(self.__symbols.symbol(symbol_id) for symbol_id in model) for model in self.__value)
+
+    def __model(self, ids: array) -> Model:
+        return Model.of_elements((self.__symbols.element(symbol_id) for symbol_id in ids), sort=True)
+
+    def __ordered_ids(self) -> list[array]:
+        # the order of ids depends on which symbols were interned first, so that models are sorted once materialized
+        if self.__order is None:
+            models = [self.__model(ids) for ids in self.__value]
+            object.__setattr__(self, '_ModelList__order',
+                               tuple(sorted(range(len(models)), key=lambda index: models[index])))
+        return [self.__value[index] for index in self.__order]
 
     def __str__(self):
-        return '-' if self.is_emtpy() else '\n'.join(str(x) for x in self.__value)
+        return '-' if self.is_emtpy() else '\n'.join(str(x) for x in self)
 
     def __len__(self):
         return len(self.__value)
 
     def __getitem__(self, item):
-        return self.__value[item]
+        if isinstance(item, slice):
+            return [self.__model(ids) for ids in self.__ordered_ids()[item]]
+        return self.__model(self.__ordered_ids()[item])
 
     def __iter__(self):
-        return iter(self.__value)
+        return (self.__model(ids) for ids in self.__ordered_ids())
 
     def is_emtpy(self):
         return len(self.__value) == 0
@@ -55,6 +219,9 @@ class ModelList:
     def is_unexplored(self):
         return self.__unexplored
 
+    def is_timed_out(self):
+        return self.__timed_out
+
 
 @typeguard.typechecked
 @dataclasses.dataclass
@@ -72,13 +239,18 @@ class ModelCount:
 @typeguard.typechecked
 @dataclasses.dataclass(frozen=True)
 class ModelCollect:
-    __value: List[Model] = dataclasses.field(default_factory=list)
+    """
+    Collect the shown symbols of each model, as sorted ids of the given SymbolTable.
+    """
+    __symbols: SymbolTable = dataclasses.field(default=DEFAULT_SYMBOL_TABLE)
+    __value: List[array] = dataclasses.field(default_factory=list)
 
     def __call__(self, model):
-        self.__value.append(Model.of_elements(x for x in model.symbols(shown=True)))
+        intern = self.__symbols.intern
+        self.__value.append(array('I', sorted(intern(symbol) for symbol in model.symbols(shown=True))))
 
     def __str__(self):
-        return '\n'.join(str(x) for x in self.__value)
+        return str(ModelList.of_ids(list(self.__value), self.__symbols))
 
     def __len__(self):
         return len(self.__value)
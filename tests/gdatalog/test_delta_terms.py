@@ -1,11 +1,14 @@
+from collections import OrderedDict
+
 import clingo
+import numpy
 import pytest
 
 from dumbo_utils.validation import ValidationError
 
-from gdatalog import utils
+from gdatalog import delta_terms, utils
 from gdatalog.delta_terms import DeltaTermsContext, flip, binom, poisson, mass_with_smart_enumeration, flip_mass, \
-    randint_mass, binom_mass, poisson_mass
+    randint_mass, binom_mass, poisson_mass, Probability, MassSampler
 
 
 def test_flip_bias_cannot_be_less_than_zero():
@@ -64,6 +67,27 @@ def test_poisson():
             assert float(res[1]) <= 0.02
 
 
+def test_batched_variates_are_reproducible():
+    def draw_all():
+        return [(binom(clingo.Number(5), clingo.Number(4), clingo.Number(10))[0],
+                 poisson(clingo.Number(6), clingo.Number(10))[0],
+                 flip(clingo.Number(1), clingo.Number(2))[0]) for _ in range(2 * delta_terms.MAX_BATCH_SIZE + 1)]
+
+    delta_terms.seed(42)
+    first = draw_all()
+    delta_terms.seed(42)
+    assert draw_all() == first
+    assert len(set(first)) > 1
+
+
+def test_batches_grow_with_the_use_of_their_key():
+    sizes = []
+    delta_terms.seed(42)
+    for _ in range(delta_terms.MIN_BATCH_SIZE * 7 + 1):
+        delta_terms.draw(("test",), lambda size: sizes.append(size) or numpy.zeros(size))
+    assert sizes == [delta_terms.MIN_BATCH_SIZE * 2**index for index in range(4)]
+
+
 def test_mass():
     res = mass_with_smart_enumeration(clingo.Number(1), clingo.Number(1))
     assert res[0].number in [0, 1]
@@ -81,6 +105,37 @@ def test_mass_with_names_as_functions():
     assert str(res[0]) in ["heads", "tails"]
 
 
+def test_mass_sampler_follows_the_biases():
+    biases = [1, 2, 3, 4, 10]
+    sampler = MassSampler.of(OrderedDict((clingo.Number(index), bias) for index, bias in enumerate(biases)))
+    assert all(0 <= threshold <= sampler.total for threshold in sampler.thresholds)
+    delta_terms.seed(0)
+    counts = [0] * len(biases)
+    for _ in range(20000):
+        counts[sampler.sample()[0]] += 1
+    for count, bias in zip(counts, biases):
+        assert count / 20000 == pytest.approx(bias / sum(biases), abs=0.02)
+
+
+@pytest.mark.parametrize("disallow", [[0], [4], [0, 1, 2, 3], [1, 2, 3, 4]])
+def test_mass_sampler_skips_disallowed_outcomes(disallow):
+    biases = [1, 2, 3, 4, 10]
+    sampler = MassSampler.of(OrderedDict((clingo.Number(index), bias) for index, bias in enumerate(biases)))
+    disallow_list = {clingo.Number(index) for index in disallow}
+    for _ in range(1000):
+        res, allowed = sampler.sample(disallow_list)
+        assert res not in disallow
+        assert allowed == 5 - len(disallow)
+    assert sampler.sample(disallow_list, most_probable=True)[0] == \
+        max(set(range(len(biases))) - set(disallow), key=lambda index: biases[index])
+
+
+def test_mass_with_all_outcomes_disallowed():
+    with pytest.raises(ValidationError):
+        mass_with_smart_enumeration(clingo.Number(1), clingo.Number(1),
+                                    disallow_list={clingo.Number(0), clingo.Number(1)})
+
+
 def test_flip_mass():
     res = flip_mass(clingo.Number(1), clingo.Number(10))
     assert res[0].number == 9
@@ -131,3 +186,65 @@ def test_poisson_mass():
         assert len(x.arguments) == 2
         assert x.arguments[0].number == i
         assert pytest.approx(x.arguments[1].number / 10**9) == expected[i]
+
+
+def test_poisson_mass_with_large_lambda():
+    res = poisson_mass(clingo.Number(2000), clingo.Number(1))
+    masses = [x.arguments[1].number for x in res]
+    assert sum(masses) >= 10**9 * 9999 // 10000 - len(masses)
+    assert res[0].arguments[0].number > 1500
+    assert poisson_mass(clingo.Number(2000), clingo.Number(1)) == res
+
+
+def test_large_binom_mass():
+    res = binom_mass(clingo.Number(3000), clingo.Number(1), clingo.Number(2))
+    assert [x.arguments[0].number for x in res] == list(range(res[0].arguments[0].number,
+                                                              res[-1].arguments[0].number + 1))
+    assert max(res, key=lambda x: x.arguments[1].number).arguments[0].number == 1500
+
+
+@pytest.fixture
+def float_probabilities():
+    Probability.set_backend("float")
+    yield
+    Probability.set_backend("fraction")
+
+
+def test_probability_backend_must_be_known():
+    with pytest.raises(ValidationError):
+        Probability.set_backend("decimal")
+
+
+def test_float_probabilities(float_probabilities):
+    assert type(Probability.of(1, 3).value) is float
+    assert float(Probability.of(1, 3) * Probability.of(3, 4)) == pytest.approx(0.25)
+    total = sum((Probability.of(1, 10) for _ in range(10)), Probability())
+    assert total < Probability.of(1)
+    assert total.complement().is_negligible()
+    res = binom(clingo.Number(5), clingo.Number(4), clingo.Number(10))
+    assert type(res[1].value) is float
+
+
+@pytest.fixture
+def log_probabilities():
+    Probability.set_backend("log")
+    yield
+    Probability.set_backend("fraction")
+
+
+def test_log_probabilities(log_probabilities):
+    assert Probability.of(1, 2).value == pytest.approx(-0.6931471805599453)
+    assert Probability().value == float("-inf")
+    assert float(Probability.of(1, 3) + Probability.of(1, 6)) == pytest.approx(0.5)
+    assert float(Probability.of(1, 2) - Probability.of(1, 6)) == pytest.approx(1 / 3)
+    assert float(Probability.of(1, 4).complement()) == pytest.approx(0.75)
+    assert float(Probability.sum_of([Probability.of(1, 4)] * 4)) == pytest.approx(1)
+
+
+def test_log_probabilities_do_not_underflow(log_probabilities):
+    chain = Probability.of(1)
+    for _ in range(2000):
+        chain *= Probability.of(1, 2)
+    assert float(chain) == 0
+    assert chain > Probability()
+    assert (chain + chain).value == pytest.approx(-1999 * 0.6931471805599453)
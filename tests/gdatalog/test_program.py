@@ -1,7 +1,22 @@
+import multiprocessing
+import pickle
+import random
+import resource
+import threading
+import tracemalloc
+import warnings
+
+import clingo
 import pytest
 
-from gdatalog.delta_terms import Probability
-from gdatalog.program import Program, Repeat, SmartRepeat
+from gdatalog.delta_terms import Probability, DeltaTermsContext
+from gdatalog.program import Program, Repeat, SmartRepeat, SystematicRepeat, FrequencyTable, SmsResultCache
+from gdatalog.utils import ModelList, SymbolTable
+
+
+def by_models(freq):
+    # keys are local to a program, and so frequencies of different programs are compared by models
+    return {str(freq.models(key)): freq.frequency(key) for key in freq.keys()}
 
 
 def test_flip_single_coin():
@@ -424,3 +439,646 @@ res(
     freq = res.sets_of_stable_models_frequency()
     assert len(freq) == 6
     # freq.print()
+
+
+def test_syntax_errors_are_reported_on_creation():
+    with pytest.raises(RuntimeError):
+        Program("res(@delta(flip(1,2)).")
+
+
+def test_parsed_program_is_reused_across_samples(monkeypatch):
+    parsed, added = [], []
+    parse_string, add = clingo.ast.parse_string, clingo.Control.add
+    monkeypatch.setattr(clingo.ast, "parse_string", lambda *args: parsed.append(args[0]) or parse_string(*args))
+    monkeypatch.setattr(clingo.Control, "add", lambda self, *args: added.append(args) or add(self, *args))
+    program = Program("res(@delta(randint(1, 1000000000))).")
+    for _ in range(10):
+        res = program.sms()
+        assert res.state.satisfiable
+        assert len(res.models) == 1
+    assert parsed == [program.code]
+    assert added == []
+    assert len(program._Program__delta_terms_to_sms_result) == 10
+
+
+def test_deterministic_part_is_replaced_by_facts():
+    program = Program("""
+edge(1,2). edge(2,3). edge(3,4).
+path(X,Y) :- edge(X,Y).
+path(X,Z) :- path(X,Y), edge(Y,Z).
+unreachable(X) :- edge(X,_), not path(1,X), X != 1.
+cut(Y, @delta(flip(1,2), Y)) :- path(1,Y).
+    """)
+    res = program.sms()
+    assert res.state.satisfiable
+    assert len(res.delta_terms) == 3
+    model = [str(atom) for atom in res.models[0]]
+    assert "path(1,4)" in model
+    assert "unreachable(1)" not in model
+
+
+def test_deterministic_part_with_choices_is_not_replaced():
+    program = Program("""
+{a; b} = 1.
+c(@delta(flip(1,2))) :- a.
+    """)
+    res = Repeat.on(program, 100)
+    freq = res.sets_of_stable_models_frequency()
+    assert 1 <= len(freq) <= 2
+    for key in freq.keys():
+        assert len(freq.models(key)) == 2
+
+
+def test_repeat_with_workers():
+    program = Program("""
+coin(@delta(flip(1,2))).
+a :- coin(0).
+b :- coin(1).
+    """)
+    res = Repeat.on(program, 1000, workers=2, seed=1)
+    res.close()
+    assert res.number_of_calls == 1000
+    assert sum(res._counters.values()) == 1000
+    freq = res.sets_of_stable_models_frequency()
+    assert len(freq) == 2
+    for key in freq.keys():
+        assert Probability.of(4, 10) <= freq.frequency(key) <= Probability.of(6, 10)
+
+
+def test_repeat_with_workers_is_reproducible():
+    program = Program("res(@delta(randint(1, 10))).")
+    res1 = Repeat.on(program, 100, workers=2, seed=1)
+    res1.close()
+    res2 = Repeat.on(Program(program.code), 100, workers=2, seed=1)
+    res2.close()
+    assert res1._counters == res2._counters
+
+
+def test_smart_repeat_under_uniform_distribution_weighs_outcomes_by_probability():
+    res = Repeat.on(Program("a(@delta((1,3))). {b} :- a(1)."), 10, smart=True)
+    freq = res.stable_models_frequency_under_uniform_distribution()
+    assert sorted((str(freq.models(key)), freq.frequency(key)) for key in freq.keys()) == [
+        ("a(0)", Probability.of(1, 4)), ("a(1)", Probability.of(3, 8)), ("a(1) b", Probability.of(3, 8)),
+    ]
+
+
+def test_smart_repeat_with_workers():
+    program = Program("""
+coin(1..3).
+heads(C, @delta((2,1), C)) :- coin(C).
+    """)
+    res = SmartRepeat.on(program, 1000, workers=2, seed=1)
+    res.close()
+    assert res.number_of_calls == 8
+    freq = res.sets_of_stable_models_frequency()
+    assert len(freq) == 8
+    expected = SmartRepeat.on(Program(program.code), 1000).sets_of_stable_models_frequency()
+    assert by_models(freq) == by_models(expected)
+
+
+def test_smart_repeat_with_workers_stops_when_exhausted():
+    program = Program("""
+coin(1, @delta((1,1))).
+coin(N+1, @delta((1,1), N)) :- coin(N, 1), N < 5.
+    """)
+    res = SmartRepeat.on(program, workers=2, seed=1)
+    while not res.repeat(2):
+        pass
+    res.close()
+    assert res.number_of_calls == 6
+    assert "UNEXPLORED" not in res.sets_of_stable_models_frequency().keys()
+
+
+def test_systematic_repeat_explores_each_outcome_once():
+    program = Program("""
+coin(1..3).
+heads(C, @delta((2,1), C)) :- coin(C).
+    """)
+    res = SystematicRepeat.on(program, 1000)
+    assert res.number_of_calls == 8
+    assert res.covered == Probability.of(1)
+    freq = res.sets_of_stable_models_frequency()
+    assert len(freq) == 8
+    expected = SmartRepeat.on(Program(program.code), 1000).sets_of_stable_models_frequency()
+    assert by_models(freq) == by_models(expected)
+
+
+def test_systematic_repeat_starts_from_the_most_probable_outcome():
+    program = Program("res(@delta((1,3,2))).")
+    res = SystematicRepeat.on(program, 1)
+    assert res.covered == Probability.of(1, 2)
+    assert not res.repeat(1)
+    assert res.covered == Probability.of(5, 6)
+
+
+def test_systematic_repeat_stops_at_coverage():
+    program = Program("""
+coin(1, @delta((1,1))).
+coin(N+1, @delta((1,1), N)) :- coin(N, 1).
+    """)
+    res = SystematicRepeat.on(program, 1000, coverage=Probability.of(99, 100))
+    assert res.number_of_calls == 7
+    assert res.covered >= Probability.of(99, 100)
+    assert "UNEXPLORED" in res.sets_of_stable_models_frequency().keys()
+
+
+def test_best_first_repeat_explores_most_probable_prefixes_first():
+    program = Program("""
+first(@delta((1,2))).
+second(@delta((1,1,1), X)) :- first(X), X > 0.
+    """)
+    res = SystematicRepeat.on(program, 2)
+    assert res.covered == Probability.of(2, 9) + Probability.of(2, 9)
+    res = SystematicRepeat.on(Program(program.code), 2, best_first=True)
+    assert res.covered == Probability.of(2, 9) + Probability.of(1, 3)
+    assert res.repeat(2)
+    assert res.unexplored == Probability()
+
+
+def test_systematic_repeat_with_time_budget():
+    program = Program("""
+coin(1, @delta((1,1))).
+coin(N+1, @delta((1,1), N)) :- coin(N, 1).
+    """)
+    res = SystematicRepeat.on(program, 1000000, best_first=True, time_budget=0.5)
+    assert 0 < res.number_of_calls < 1000000
+    assert res.repeat(1)
+
+
+def test_repeat_with_float_probabilities():
+    Probability.set_backend("float")
+    try:
+        program = Program("""
+coin(@delta(flip(1,3))).
+        """)
+        res = Repeat.on(program, 1000)
+        freq = res.sets_of_stable_models_frequency()
+        assert len(freq) == 2
+        assert "UNEXPLORED" not in freq.keys()
+    finally:
+        Probability.set_backend("fraction")
+
+
+def test_smart_repeat_with_log_probabilities():
+    Probability.set_backend("log")
+    try:
+        program = Program("""
+coin(1..3).
+heads(C, @delta((2,1), C)) :- coin(C).
+        """)
+        res = SmartRepeat.on(program, 1000)
+        freq = res.sets_of_stable_models_frequency()
+        assert len(freq) == 8
+        assert float(Probability.sum_of(freq.frequency(key) for key in freq.keys())) == pytest.approx(1)
+        assert res.no_stable_model_frequency() == Probability()
+    finally:
+        Probability.set_backend("fraction")
+
+
+def test_memory_is_flat_on_long_repeat():
+    program = Program("""
+coin(@delta(flip(1,2))).
+a :- coin(1).
+    """)
+    res = Repeat.on(program, 10000)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    res.repeat(90000)
+    assert res.number_of_calls == 100000
+    assert resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss < 20 * 1024  # KB on Linux
+
+
+def test_repeat_with_bounded_cache():
+    program = Program("res(@delta(randint(1, 10))).", cache_size=2)
+    res = Repeat.on(program, 200)
+    freq = res.sets_of_stable_models_frequency()
+    assert len(freq) == 10
+    assert sum(1 for key in res._counters if key in program._Program__delta_terms_to_sms_result) == 2
+    with pytest.raises(KeyError):
+        for key in res._counters:
+            program.sms(delta_terms=key)
+
+
+def test_estimated_memory_of_bounded_cache_does_not_grow():
+    program = Program("res(@delta(randint(1, 1000000000))).", cache_size=10)
+    res = Repeat.on(program, 10)
+    size = program.cached_results_bytes
+    assert size > 10 * SmsResultCache.RESULT_BYTES
+    res.repeat(100)
+    assert program.cached_results_bytes == size
+
+
+def test_repeat_with_cache_spilled_to_disk(tmp_path):
+    program = Program("res(@delta(randint(1, 10))).", cache_size=2, cache_directory=str(tmp_path))
+    res = Repeat.on(program, 200)
+    assert len(res.sets_of_stable_models_frequency()) == 10
+    for key in res._counters:
+        assert len(program.sms(delta_terms=key).models) == 1
+
+
+def test_repeat_with_cache_spilled_to_disk_and_workers(tmp_path):
+    program = Program("res(@delta(randint(1, 50))).", cache_size=2, cache_directory=str(tmp_path))
+    program.sms()
+    res = Repeat.on(program, 2000, workers=2, seed=1)
+    res.close()
+    assert res.number_of_calls == 2000
+    assert len(res.sets_of_stable_models_frequency()) == 50
+
+
+def _sample(program: Program, times: int) -> None:
+    for _ in range(times):
+        program.sms()
+
+
+def test_cache_spilled_to_disk_is_not_shared_with_forked_processes(tmp_path):
+    program = Program("res(@delta(randint(1, 50))).", cache_size=2, cache_directory=str(tmp_path))
+    results = [program.sms() for _ in range(20)]
+    process = multiprocessing.get_context("fork").Process(target=_sample, args=(program, 200))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    for result in results:
+        assert program.sms(delta_terms=result.delta_terms).models == result.models
+
+
+def test_cache_spilled_to_disk_is_shared_by_smart_and_plain_repeat(tmp_path):
+    program = Program("""
+a(@delta((1,1))).
+b(@delta((1,1))).
+c(@delta((1,1))).
+    """, cache_size=1, cache_directory=str(tmp_path))
+    SmartRepeat.on(program, 100)
+    res = Repeat.on(program, 200)
+    assert res.number_of_calls == 200
+    assert len(res.sets_of_stable_models_frequency()) == 2
+
+
+def test_known_trace_without_result_is_grounded_again(monkeypatch):
+    program = Program("a(@delta(randint(1, 3))).")
+    Repeat.on(program, 50)
+    # results are lost, but their traces are still known
+    monkeypatch.setattr(SmsResultCache, "get", lambda self, delta_terms: None)
+    res = program.sms()
+    assert len(res.models) == 1
+    assert str(res.models[0]) == f"a({res.delta_terms[0].result})"
+
+
+def test_grounding_stops_at_known_traces(monkeypatch):
+    calls = []
+    mass = DeltaTermsContext.mass
+    monkeypatch.setattr(DeltaTermsContext, "mass", lambda self, function: calls.append(function) or mass(self, function))
+    program = Program("""
+a(@delta(flip(1,2))).
+b(@mass(flip(X+1,2))) :- a(X).
+    """)
+    res = Repeat.on(program, 50)
+    assert len(res._counters) == 2
+    assert len(calls) == 2
+    for key in res._counters:
+        assert len(program.sms(delta_terms=key).models) == 1
+
+
+def test_program_without_delta_terms_is_solved_once():
+    program = Program("a. b :- a.")
+    assert program.sms() is program.sms()
+
+
+def test_streaming_repeat_matches_repeat():
+    program = Program("""
+coin(@delta(flip(1,2))).
+a :- coin(0).
+b :- coin(1).
+{c} :- coin(1).
+    """)
+    expected = Repeat.on(program, 500, seed=1)
+    res = Repeat.on(Program(program.code), 500, seed=1, streaming=True)
+    assert res.number_of_calls == 500
+    assert len(res._counters) == 0
+    assert by_models(res.sets_of_stable_models_frequency()) == by_models(expected.sets_of_stable_models_frequency())
+    assert by_models(res.stable_models_frequency_under_uniform_distribution()) == \
+        by_models(expected.stable_models_frequency_under_uniform_distribution())
+
+
+def test_streaming_repeat_atom_marginals():
+    program = Program("""
+coin(@delta(flip(1,2))).
+a :- coin(0).
+b :- coin(1).
+{c} :- coin(1).
+#show a/0.
+#show b/0.
+#show c/0.
+    """)
+    res = Repeat.on(program, 1000, streaming=True)
+    marginals = {str(atom): value for atom, value in res.atom_marginals().items()}
+    assert set(marginals.keys()) == {"a", "b", "c"}
+    assert marginals["a"].brave == marginals["a"].cautious
+    assert marginals["b"].brave == marginals["b"].cautious == marginals["c"].brave
+    assert marginals["c"].cautious == Probability.of(0)
+    assert marginals["a"].brave + marginals["b"].brave == Probability.of(1)
+
+
+def test_atom_marginals_of_repeat():
+    program = Program("""
+coin(@delta(flip(1,4))).
+a :- coin(1).
+{b; c}.
+#show a/0.
+#show b/0.
+#show c/0.
+    """)
+    res = Repeat.on(program, 1000, seed=1)
+    marginals = {str(atom): value for atom, value in res.atom_marginals().items()}
+    assert set(marginals.keys()) == {"a", "b", "c"}
+    assert marginals["b"].brave == Probability.of(1)
+    assert marginals["b"].cautious == Probability.of(0)
+    low, high = marginals["a"].brave_interval
+    assert low < 0.25 < high
+    assert low <= float(marginals["a"].brave) <= high
+
+
+def test_atom_marginals_restricted_to_predicates():
+    program = Program("""
+coin(@delta(flip(1,2))).
+a(X) :- coin(X).
+b(X,X) :- coin(X).
+#show a/1.
+#show b/2.
+    """)
+    res = Repeat.on(program, 100, seed=1)
+    assert {atom.predicate_name for atom in res.atom_marginals(["a"])} == {"a"}
+    assert {atom.predicate_name for atom in res.atom_marginals(["b/2"])} == {"b"}
+    assert res.atom_marginals(["b/1"]) == {}
+
+
+def test_atom_marginals_of_smart_repeat_are_exact():
+    program = Program("""
+coin(@delta((3,1))).
+a :- coin(1).
+#show a/0.
+    """)
+    res = Repeat.on(program, 1000, smart=True)
+    marginals = {str(atom): value for atom, value in res.atom_marginals().items()}
+    assert marginals["a"].brave == marginals["a"].cautious == Probability.of(1, 4)
+    assert marginals["a"].brave_interval == (0.25, 0.25)
+
+
+def test_atom_marginals_with_workers():
+    program = Program("""
+coin(@delta((1,1))).
+a :- coin(1).
+#show a/0.
+    """)
+    res = Repeat.on(program, 1000, workers=2, seed=1)
+    res.close()
+    marginals = {str(atom): value for atom, value in res.atom_marginals().items()}
+    assert Probability.of(4, 10) <= marginals["a"].brave <= Probability.of(6, 10)
+    res = SmartRepeat.on(Program(program.code), 1000, workers=2, seed=1)
+    res.close()
+    marginals = {str(atom): value for atom, value in res.atom_marginals().items()}
+    assert marginals["a"].brave == Probability.of(1, 2)
+
+
+def test_streaming_repeat_discards_traces():
+    program = Program("""
+x(@delta(randint(1, 1000))).
+a :- x(X), X > 500.
+#show a/0.
+    """, cache_size=10)
+    res = Repeat.on(program, 2000, streaming=True)
+    assert len(res._counters) == 0
+    assert len(res._models) == 2
+    assert len(res.sets_of_stable_models_frequency()) == 2
+
+
+def test_memory_is_flat_on_long_streaming_repeat_with_the_default_cache():
+    program = Program("""
+x(@delta(randint(1, 1000000000))).
+a :- x(X), X > 500000000.
+#show a/0.
+    """)
+    res = Repeat.on(program, 1000, streaming=True)
+    tracemalloc.start()
+    try:
+        res.repeat(5000)
+        assert tracemalloc.get_traced_memory()[0] < 1024 * 1024
+    finally:
+        tracemalloc.stop()
+    assert res.number_of_calls == 6000
+    assert len(program._Program__delta_terms_to_sms_result) == 0
+
+
+def test_streaming_repeat_with_workers():
+    program = Program("res(@delta(randint(1, 10))).")
+    res = Repeat.on(program, 1000, workers=2, seed=1, streaming=True)
+    res.close()
+    assert res.number_of_calls == 1000
+    assert res._frequencies.total == 1000
+    assert len(res.sets_of_stable_models_frequency()) == 10
+
+
+def test_repeat_with_workers_does_not_fork_a_multi_threaded_process():
+    stop = threading.Event()
+    thread = threading.Thread(target=stop.wait)
+    thread.start()
+    try:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            res = Repeat.on(Program("res(@delta(randint(1, 10)))."), 100, workers=2, seed=1)
+            res.close()
+    finally:
+        stop.set()
+        thread.join()
+    assert res.number_of_calls == 100
+    assert not [warning for warning in caught if "fork()" in str(warning.message)]
+
+
+def test_smart_repeat_cannot_be_streamed():
+    with pytest.raises(ValueError):
+        Repeat.on(Program("res(@delta((1,1)))."), smart=True, streaming=True)
+
+
+def test_frequency_table_tracks_the_heaviest_keys():
+    table = FrequencyTable(top_size=5)
+    weights = {}
+    generator = random.Random(1)
+    for _ in range(2000):
+        key = int(generator.paretovariate(1)) % 50
+        table.add(key, 1)
+        weights[key] = weights.get(key, 0) + 1
+        top = table.top()
+        assert len(top) == min(5, len(weights))
+        assert [weight for _, weight in top] == sorted(weights.values(), reverse=True)[:len(top)]
+    assert dict(table.items()) == weights
+    assert table.total == 2000
+
+
+def test_top_sets_of_stable_models_frequency():
+    program = Program("res(@delta(randint(1, 10))).")
+    res = Repeat.on(program, 500, top_size=3)
+    top = res.top_sets_of_stable_models_frequency()
+    assert len(top) == 3
+    assert res.number_of_sets_of_stable_models == 10
+    freq = res.sets_of_stable_models_frequency()
+    assert [probability for probability, _ in top] == sorted((freq.frequency(key) for key in freq.keys()),
+                                                             reverse=True)[:3]
+
+
+def test_top_sets_of_stable_models_frequency_reports_unexplored_mass():
+    program = Program("""
+coin(1..3).
+heads(C, @delta((2,1), C)) :- coin(C).
+    """)
+    res = SmartRepeat.on(program, 3)
+    top = res.top_sets_of_stable_models_frequency()
+    assert top[0][1].is_unexplored()
+    assert Probability.sum_of(probability for probability, _ in top) == Probability.of(1)
+
+
+def test_sets_of_stable_models_are_identified_by_fingerprint():
+    program = Program("{a; b}.")
+    res = program.sms()
+    models = res.models
+    assert models.fingerprint == ModelList.of(reversed(list(models)), program.symbols).fingerprint
+    assert len(set(models.model_fingerprints)) == 4
+    assert pickle.loads(pickle.dumps(models)).fingerprint == models.fingerprint
+    assert models.fingerprint != ModelList.unexplored().fingerprint
+    assert ModelList.empty().fingerprint != ModelList.unexplored().fingerprint
+
+
+def test_models_are_listed_in_the_same_order_whatever_symbols_were_seen_first():
+    listed = []
+    for first in ("a", "b"):
+        symbols = SymbolTable()
+        symbols.intern(clingo.Function(first))
+        models = ModelList.of_symbols([[clingo.Function("b")], [clingo.Function("a")], [clingo.Function("c")]], symbols)
+        listed.append(([str(model) for model in models], str(models), str(models[0]), [str(x) for x in models[1:]]))
+    assert listed[0] == listed[1] == (["a", "b", "c"], "a\nb\nc", "a", ["b", "c"])
+
+
+def test_uniform_distribution_is_keyed_by_model():
+    program = Program("""
+coin(@delta(flip(1,2))).
+a :- coin(0).
+{b} :- coin(1).
+    """)
+    res = Repeat.on(program, 100)
+    freq = res.stable_models_frequency_under_uniform_distribution()
+    assert len(freq) == 3
+    assert Probability.sum_of(freq.frequency(key) for key in freq.keys()) == Probability.of(1)
+    assert all(len(freq.models(key)) == 1 for key in freq.keys())
+
+
+@pytest.mark.parametrize("consequences", ["brave", "cautious"])
+def test_program_with_consequences_computes_a_single_model(consequences):
+    program = Program("""
+{a; b; c}.
+:- not a, not b.
+#show a/0.
+#show b/0.
+#show c/0.
+    """, consequences=consequences)
+    res = program.sms()
+    assert len(res.models) == 1
+    expected = {"a", "b", "c"} if consequences == "brave" else set()
+    assert set(str(atom) for atom in res.models[0]) == expected
+
+
+def test_program_with_consequences_requires_all_stable_models():
+    with pytest.raises(ValueError):
+        Program("a.", max_stable_models=1, consequences="brave")
+    with pytest.raises(ValueError):
+        Program("a.", consequences="unknown")
+
+
+@pytest.mark.parametrize("consequences", ["brave", "cautious"])
+def test_atom_marginals_with_consequences(consequences):
+    code = """
+coin(@delta((1,1))).
+{a; b} :- coin(1).
+a :- coin(0).
+#show a/0.
+#show b/0.
+    """
+    res = Repeat.on(Program(code, consequences=consequences), 1000, smart=True)
+    expected = Repeat.on(Program(code), 1000, smart=True)
+    marginals = {str(atom): value for atom, value in res.atom_marginals().items()}
+    expected_marginals = {str(atom): value for atom, value in expected.atom_marginals().items()}
+    for atom, marginal in marginals.items():
+        assert getattr(marginal, consequences) == getattr(expected_marginals[atom], consequences)
+    other = "cautious" if consequences == "brave" else "brave"
+    assert all(getattr(marginal, other) is None for marginal in marginals.values())
+    assert "a" in marginals
+
+
+def test_program_with_consequences_is_pickled_with_its_mode():
+    program = Program("a.", consequences="cautious")
+    assert pickle.loads(pickle.dumps(program)).consequences == "cautious"
+
+
+PIGEONHOLE_ON_HEADS = """
+coin(@delta(flip(1,2))).
+pigeon(1..30).
+hole(1..29).
+{ in(P,H) : hole(H) } = 1 :- pigeon(P), coin(1).
+:- in(P,H), in(P',H), P < P'.
+#show coin/1.
+"""
+
+
+def test_program_with_solve_timeout():
+    program = Program(PIGEONHOLE_ON_HEADS, solve_timeout=0.2)
+    res = Repeat.on(program, 100, seed=1)
+    assert Probability.of(4, 10) <= res.timed_out_frequency() <= Probability.of(6, 10)
+    assert res.no_stable_model_frequency() == Probability.of(0)
+    freq = res.sets_of_stable_models_frequency()
+    assert len(freq) == 2
+    assert sum(1 for _, models in freq.values() if models.is_timed_out()) == 1
+
+
+def test_program_with_solve_timeout_and_workers():
+    program = Program(PIGEONHOLE_ON_HEADS, solve_timeout=0.2)
+    res = Repeat.on(program, 20, workers=2, seed=1)
+    res.close()
+    assert res.timed_out_frequency() > Probability.of(0)
+    assert res.no_stable_model_frequency() == Probability.of(0)
+
+
+def test_timed_out_samples_are_not_counted_as_incoherent_nor_in_atom_marginals():
+    program = Program(PIGEONHOLE_ON_HEADS, solve_timeout=0.2)
+    res = Repeat.on(program, 20, seed=1)
+    assert res.timed_out_frequency() > Probability.of(0)
+    freq = res.stable_models_frequency_under_uniform_distribution()
+    assert "INCOHERENT" not in freq.keys()
+    assert freq.frequency("TIMED OUT") == res.timed_out_frequency()
+    marginals = res.atom_marginals()
+    assert {str(atom) for atom in marginals} == {"coin(0)"}
+    assert all(marginal.brave == Probability.of(1) for marginal in marginals.values())
+    assert all(marginal.cautious == Probability.of(1) for marginal in marginals.values())
+
+
+def test_timed_out_samples_are_not_cached():
+    program = Program(PIGEONHOLE_ON_HEADS, solve_timeout=0.2)
+    res = Repeat.on(program, 20, seed=1)
+    assert res.timed_out_frequency() > Probability.of(0)
+    cache = program._Program__delta_terms_to_sms_result
+    assert len(cache) == 1
+    assert [str(call.result) for call in cache.traces] == ["0"]
+
+
+def test_timed_out_models_differ_from_no_models():
+    assert ModelList.timed_out().fingerprint != ModelList.empty().fingerprint
+    assert ModelList.timed_out().is_emtpy()
+    assert not ModelList.empty().is_timed_out()
+
+
+def test_repeat_passes_each_sample_to_on_sample():
+    program = Program("a(@delta(flip(1,2))).")
+    samples = []
+    res = Repeat.on(program, streaming=True)
+    res.repeat(10, on_sample=samples.append)
+    assert len(samples) == 10
+    assert res._frequencies.total == 10
+    other = Repeat.on(Program(program.code), streaming=True)
+    other.merge(res._aggregates(), res.number_of_calls)
+    assert other.number_of_calls == 10
+    assert by_models(other.sets_of_stable_models_frequency()) == by_models(res.sets_of_stable_models_frequency())
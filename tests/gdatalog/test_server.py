@@ -0,0 +1,216 @@
+import json
+import os
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from fastapi.testclient import TestClient
+
+from gdatalog import server
+from gdatalog.program import Program, SmsResultCache
+from gdatalog.server import SolverPool, ProgramCache
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(server, "WORKERS", 1)
+    with TestClient(server.app) as res:
+        yield res
+
+
+def test_run(client):
+    response = client.post("/run/", json={"program": "a. {b}.", "max_stable_models": 0})
+    assert response.status_code == 200
+    json = response.json()
+    assert json["state"] == "SAT"
+    assert sorted(sorted(atom["str"] for atom in model) for model in json["models"]) == [["a"], ["a", "b"]]
+
+
+def test_run_reports_errors(client):
+    response = client.post("/run/", json={"program": "a :- "})
+    assert "error" in response.json()
+
+
+def test_run_is_rejected_when_the_pool_is_saturated(client):
+    client.app.state.pool.shutdown()
+    client.app.state.pool = SolverPool(workers=1, max_pending=1)
+    pending = client.app.state.pool.submit(time.sleep, 1)
+    assert client.app.state.pool.saturated
+    response = client.post("/run/", json={"program": "a."})
+    assert response.status_code == 429
+    pending.result()
+    response = client.post("/run/", json={"program": "a."})
+    assert response.status_code == 200
+
+
+def test_run_times_out(client, monkeypatch):
+    monkeypatch.setattr(server, "TIMEOUT", 0.5)
+    client.app.state.pool.shutdown()
+    client.app.state.pool = SolverPool(workers=1, max_pending=2)
+    client.app.state.pool.submit(time.sleep, 2)
+    response = client.post("/run/", json={"program": "a."})
+    assert response.status_code == 504
+
+
+def test_solver_pool_counts_pending_tasks():
+    pool = SolverPool(workers=1, max_pending=2)
+    future = pool.submit(sum, [1, 2])
+    assert future.result() == 3
+    pool.shutdown()
+    assert pool.pending == 0
+
+
+def test_program_cache_hits_and_misses():
+    cache = ProgramCache(max_bytes=2**20, max_results_per_program=10)
+    program, cached = cache.get("a.", 0, None)
+    assert not cached
+    assert cache.get("a.", 0, None) == (program, True)
+    assert not cache.get("a.", 1, None)[1]
+    assert len(cache) == 2
+
+
+def test_program_cache_evicts_least_recently_used_programs():
+    size = ProgramCache.size(Program("a(1)."))
+    cache = ProgramCache(max_bytes=2 * size, max_results_per_program=10)
+    cache.get("a(1).", 0, None)
+    cache.get("a(2).", 0, None)
+    cache.get("a(1).", 0, None)
+    cache.get("a(3).", 0, None)
+    assert len(cache) == 2
+    assert cache.bytes == 2 * size
+    assert cache.get("a(1).", 0, None)[1]
+    assert not cache.get("a(2).", 0, None)[1]
+
+
+def test_program_cache_charges_results_and_symbols_of_programs():
+    cache = ProgramCache(max_bytes=2**20, max_results_per_program=10000)
+    program, _ = cache.get("a(@delta(randint(1, 1000000000))).", 0, None)
+    size = cache.bytes
+    for _ in range(1000):
+        program.sms()
+    assert cache.bytes > size + 1000 * (ProgramCache.SYMBOL_BYTES + SmsResultCache.RESULT_BYTES)
+    cache.get("b.", 0, None)
+    assert len(cache) == 1
+    assert not cache.get("a(@delta(randint(1, 1000000000))).", 0, None)[1]
+
+
+def test_program_cache_of_size_zero_is_disabled():
+    cache = ProgramCache(max_bytes=0, max_results_per_program=10)
+    cache.get("a.", 0, None)
+    assert not cache.get("a.", 0, None)[1]
+    assert len(cache) == 0
+
+
+def test_run_reuses_programs(client):
+    for _ in range(3):
+        client.post("/run/", json={"program": "a(@delta(flip(1,2)))."})
+    metrics = client.get("/metrics/").json()
+    assert metrics["program_cache_misses"] == 1
+    assert metrics["program_cache_hits"] == 2
+    assert metrics["pending"] == 0
+
+
+def test_run_batch(client):
+    response = client.post("/run/", json=[
+        {"program": "a(@delta(randint(1, 1000))).", "seed": 1},
+        {"program": "a(@delta(randint(1, 1000))).", "seed": 1},
+        {"program": "a :- "},
+    ])
+    json = response.json()
+    assert len(json) == 3
+    assert json[0]["models"] == json[1]["models"]
+    assert "error" in json[2]
+
+
+def test_repeat(client):
+    response = client.post("/repeat/", json={"program": "a(@delta(flip(1,2))).", "times": 100, "seed": 1})
+    json = response.json()
+    assert json["number_of_calls"] == 100
+    assert len(json["outcomes"]) == 2
+    assert sum(outcome["probability"] for outcome in json["outcomes"]) == pytest.approx(1)
+
+
+def test_repeat_returns_partial_results_before_the_timeout(client, monkeypatch):
+    monkeypatch.setattr(server, "TIMEOUT", 2)
+    client.app.state.pool.shutdown()
+    client.app.state.pool = SolverPool(workers=1, max_pending=2)
+    client.app.state.pool.submit(time.sleep, 1)
+    response = client.post("/repeat/", json={"program": "a(@delta(flip(1,2))).", "times": 10**9})
+    assert response.status_code == 200
+    assert 0 < response.json()["number_of_calls"] < 10**9
+
+
+SLOW_PROGRAM = "n(@delta(randint(1, 1000000000))). p(X) :- X = 1..200000, n(_). #show n/1."
+
+
+def test_repeat_of_a_slow_program_returns_partial_results_before_the_timeout(client, monkeypatch):
+    monkeypatch.setattr(server, "TIMEOUT", 3)
+    client.post("/run/", json={"program": SLOW_PROGRAM})
+    response = client.post("/repeat/", json={"program": SLOW_PROGRAM, "times": 1000})
+    assert response.status_code == 200
+    assert 0 < response.json()["number_of_calls"] < 100
+
+
+def test_smart_repeat(client):
+    response = client.post("/repeat/", json={"program": "a(@delta((1,3))).", "smart": True})
+    json = response.json()
+    assert json["number_of_calls"] == 2
+    assert [outcome["probability"] for outcome in json["outcomes"]] == [0.75, 0.25]
+    assert [outcome["models"][0][0]["str"] for outcome in json["outcomes"]] == ["a(1)", "a(0)"]
+
+
+def test_repeat_stream(client):
+    response = client.post("/repeat/stream/", json={
+        "program": "a(@delta(flip(1,2))).", "times": 250, "update_frequency": 100, "seed": 1, "samples": True,
+    })
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    events = [json.loads(line) for line in response.text.splitlines()]
+    snapshots = [event for event in events if event["type"] == "snapshot"]
+    assert [snapshot["number_of_calls"] for snapshot in snapshots] == [100, 200, 250]
+    assert sum(1 for event in events if event["type"] == "sample") == 250
+    assert len(snapshots[-1]["outcomes"]) == 2
+    assert sum(outcome["probability"] for outcome in snapshots[-1]["outcomes"]) == pytest.approx(1)
+
+
+def test_repeat_stream_of_a_slow_program_reports_the_runs_performed_before_the_timeout(client, monkeypatch):
+    monkeypatch.setattr(server, "TIMEOUT", 3)
+    client.post("/run/", json={"program": SLOW_PROGRAM})
+    response = client.post("/repeat/stream/", json={"program": SLOW_PROGRAM, "times": 60, "update_frequency": 60})
+    events = [json.loads(line) for line in response.text.splitlines()]
+    assert [event.get("error") for event in events] == [None] * len(events)
+    calls = [event["number_of_calls"] for event in events]
+    assert 0 < calls[0] < 60
+    assert calls == sorted(calls)
+    assert calls[-1] == 60
+
+
+def test_repeat_stream_as_server_sent_events(client):
+    response = client.post("/repeat/stream/", json={"program": "a.", "times": 10, "format": "sse"})
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.text.startswith("event: snapshot\ndata: ")
+
+
+def test_repeat_stream_reports_errors(client):
+    response = client.post("/repeat/stream/", json={"program": "a :- "})
+    assert "error" in response.json()
+
+
+def test_run_works_after_a_worker_crashes(client):
+    client.app.state.pool.shutdown()
+    client.app.state.pool = SolverPool(workers=1, max_pending=2)
+    crash = client.app.state.pool.submit(os._exit, 1)
+    with pytest.raises(BrokenProcessPool):
+        crash.result()
+    for _ in range(3):
+        response = client.post("/run/", json={"program": "a."})
+        assert response.status_code == 200
+        assert response.json()["state"] == "SAT"
+    assert client.app.state.pool.pending == 0
+
+
+def test_repeat_stream_prepares_programs_only_in_workers(client, monkeypatch):
+    prepared = []
+    monkeypatch.setattr(server, "Program", lambda code, **kwargs: prepared.append(code) or Program(code, **kwargs))
+    response = client.post("/repeat/stream/", json={"program": "a(@delta(flip(1,2))).", "times": 10})
+    assert len(response.text.splitlines()) == 1
+    assert "a(@delta(flip(1,2)))." not in prepared